@@ -59,7 +59,7 @@ resource "aws_iam_role" "lambda_role" {
       Statement = [
         {
           Effect   = "Allow"
-          Action   = "ssm:GetParameter"
+          Action   = ["ssm:GetParameter", "ssm:GetParameters"]
           Resource = "arn:aws:ssm:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:parameter/cid/${local.resource_prefix}*"
         }
       ]
@@ -92,6 +92,21 @@ resource "aws_iam_role" "lambda_role" {
             "s3:PutObject"
           ]
           Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/*"
+        },
+        {
+          Effect   = "Allow"
+          Action   = "s3:DeleteObject"
+          Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/account-list/results/*"
+        },
+        {
+          Effect   = "Allow"
+          Action   = "s3:ListBucket"
+          Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}"
+          Condition = {
+            StringLike = {
+              "s3:prefix" = ["account-list/results/*"]
+            }
+          }
         }
       ]
     })
@@ -113,6 +128,7 @@ resource "aws_lambda_function" "account_collector" {
   handler       = "account_collector.lambda_handler"
   memory_size   = 2688
   timeout       = 600
+  layers        = [aws_lambda_layer_version.common.arn]
 
   filename = "./scripts/account_collector.zip"
 
@@ -125,6 +141,8 @@ resource "aws_lambda_function" "account_collector" {
       PREDEF_ACCOUNT_LIST_KEY = "account-list/account-list"
       LINKED_ACCOUNT_LIST_KEY = "account-list/linked-account-list.json"
       PAYER_ACCOUNT_LIST_KEY  = "account-list/payer-account-list.json"
+      ORG_SNAPSHOT_TTL        = var.org_snapshot_ttl
+      MAX_WORKERS             = 8
     }
   }
 }
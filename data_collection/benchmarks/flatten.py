@@ -0,0 +1,148 @@
+""" Measure the records/second of the record flattening of cost_anomaly and health_events:
+the previous implementations (get_value_by_path per field, JMESPath projection) vs cid_dc.flatten.
+
+Usage:
+    python benchmarks/flatten.py [--records 100000]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timezone
+
+import jmespath
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+for name in ['BUCKET_NAME', 'ROLENAME', 'ROLE_NAME', 'PREFIX', 'DETAIL_SM_ARN']:
+    os.environ.setdefault(name, 'benchmark')
+os.environ.setdefault('LOOKBACK', '90')
+import cost_anomaly #pylint: disable=wrong-import-position
+import health_events #pylint: disable=wrong-import-position
+
+
+def get_value_by_path(data, path, default=None):
+    """ previous cost_anomaly implementation """
+    cost_anomaly.logger.debug(f"Traversing for path {path}")
+    keys = path.split("/")
+    current = data
+    for key in keys:
+        if isinstance(current, dict) and key in current:
+            current = current.get(key, default)
+        elif isinstance(current, list) and key.isdigit():
+            try:
+                current = current[int(key)]
+            except IndexError:
+                cost_anomaly.logger.debug(f"Index value {key} within path {path} is not valid in get_value_by_path for data {data}, returning default of {default}")
+                return default
+        else:
+            cost_anomaly.logger.debug(f"Key value {key} within path {path} is not valid in get_value_by_path for data {data}, returning default of {default}")
+            return default
+    return current
+
+
+def previous_parse_anomaly(record):
+    """ previous cost_anomaly.parse_record """
+    cost_anomaly.logger.debug(f"Processing record {record}")
+    return {
+        'AnomalyId': get_value_by_path(record, 'AnomalyId'),
+        'AnomalyStartDate': get_value_by_path(record, 'AnomalyStartDate'),
+        'AnomalyEndDate': get_value_by_path(record, 'AnomalyEndDate'),
+        'DimensionValue': get_value_by_path(record, 'DimensionValue'),
+        'MaxImpact': get_value_by_path(record, 'Impact/MaxImpact'),
+        'TotalActualSpend': get_value_by_path(record, 'Impact/TotalActualSpend'),
+        'TotalExpectedSpend': get_value_by_path(record, 'Impact/TotalExpectedSpend'),
+        'TotalImpact': get_value_by_path(record, 'Impact/TotalImpact'),
+        'TotalImpactpercentage': float(get_value_by_path(record, 'Impact/TotalImpactPercentage', 0.0)),
+        'MonitorArn': get_value_by_path(record, 'MonitorArn'),
+        'LinkedAccount': get_value_by_path(record, 'RootCauses/0/LinkedAccount'),
+        'LinkedAccountName': get_value_by_path(record, 'RootCauses/0/LinkedAccountName'),
+        'Region': get_value_by_path(record, 'RootCauses/0/Region'),
+        'Service': get_value_by_path(record, 'RootCauses/0/Service'),
+        'UsageType': get_value_by_path(record, 'RootCauses/0/UsageType')
+    }
+
+
+def previous_flatten_health(records):
+    """ previous health_events projection and metadata conversion """
+    paths = {name: spec if isinstance(spec, str) else spec['path'] for name, spec in health_events.mapping.items()}
+    flatten_events = jmespath.search("[].{"+', '.join([f'{k}: {v}' for k, v in paths.items()]) + "}", records)
+    for flatten_event in flatten_events:
+        metadata = flatten_event.get('event_metadata')
+        metadata = json.dumps(metadata) if (not isinstance(metadata, str)) and (metadata is not None) else metadata
+        flatten_event['event_metadata'] = metadata
+    return flatten_events
+
+
+def synthetic_anomalies(count):
+    """ records shaped like ce get_anomalies results """
+    for i in range(count):
+        record = {
+            'AnomalyId': f'{i:08x}-0000-0000-0000-000000000000',
+            'AnomalyStartDate': '2024-01-01T00:00:00Z',
+            'AnomalyEndDate': '2024-01-02T00:00:00Z',
+            'DimensionValue': random.choice(['Amazon Elastic Compute Cloud - Compute', 'Amazon Simple Storage Service']),
+            'Impact': {'MaxImpact': 10.5, 'TotalActualSpend': 120.0, 'TotalExpectedSpend': 100.0, 'TotalImpact': 20.0},
+            'MonitorArn': 'arn:aws:ce::123456789012:anomalymonitor/benchmark',
+            'AnomalyScore': {'MaxScore': 0.9, 'CurrentScore': 0.5},
+            'Feedback': 'YES',
+        }
+        if i % 3:
+            record['Impact']['TotalImpactPercentage'] = 20.0
+        if i % 5:
+            record['RootCauses'] = [{'Service': 'Amazon EC2', 'Region': 'us-east-1', 'LinkedAccount': f'{i % 1000:012d}',
+                                     'LinkedAccountName': 'benchmark', 'UsageType': 'BoxUsage:m5.large'}]
+        yield record
+
+
+def synthetic_health_entities(count):
+    """ records shaped like the merged events of health_events.pull_event_details """
+    now = datetime.now(timezone.utc)
+    for i in range(count):
+        yield {
+            'arn': 'arn:aws:health:us-east-1::event/EC2/AWS_EC2_OPERATIONAL_ISSUE/benchmark',
+            'eventScopeCode': 'ACCOUNT_SPECIFIC',
+            'payer_account_id': '999999999999',
+            'event_source': 'aws.health',
+            'ingestion_time': now,
+            'awsAccountId': f'{i % 1000:012d}',
+            'eventArn': 'arn:aws:health:us-east-1::event/EC2/AWS_EC2_OPERATIONAL_ISSUE/benchmark',
+            'entityValue': f'i-{i:017x}',
+            'entityStatusCode': 'IMPAIRED',
+            'entityLastUpdatedTime': now,
+            'event': {'arn': 'arn', 'eventTypeCode': 'AWS_EC2_OPERATIONAL_ISSUE', 'eventTypeCategory': 'issue', 'service': 'EC2',
+                      'region': 'us-east-1', 'startTime': now, 'lastUpdatedTime': now, 'statusCode': 'open'},
+            'eventDescription': {'latestDescription': 'Increased API error rates'},
+            'eventMetadata': {'key': 'value'} if i % 2 else '',
+        }
+
+
+def measure(name, function, count):
+    start = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - start
+    print(f'{name:<28} {count / duration:12,.0f} records/s')
+    return result, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+
+    anomalies = list(synthetic_anomalies(args.records))
+    expected, before = measure('cost_anomaly previous', lambda: [previous_parse_anomaly(record) for record in anomalies], args.records)
+    result, after = measure('cost_anomaly flatten', lambda: [cost_anomaly.parse_record(record) for record in anomalies], args.records)
+    assert result == expected, 'cost_anomaly outputs differ'
+    print(f'{"":<28} x{before / after:.1f}')
+
+    entities = list(synthetic_health_entities(args.records))
+    expected, before = measure('health_events previous', lambda: previous_flatten_health(entities), args.records)
+    result, after = measure('health_events flatten', lambda: health_events.flatten.flatten_all(entities), args.records)
+    assert result == expected, 'health_events outputs differ'
+    print(f'{"":<28} x{before / after:.1f}')
+
+
+if __name__ == '__main__':
+    main()
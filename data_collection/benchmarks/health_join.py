@@ -0,0 +1,93 @@
+""" Compare the join of affected entities to event details in health_events:
+one JMESPath filter per entity (previous implementation) vs the (account, event arn) index.
+
+Usage:
+    python benchmarks/health_join.py [--accounts 1000] [--entities 10000]
+"""
+import os
+import sys
+import copy
+import time
+import argparse
+
+import jmespath
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+for name in ['BUCKET_NAME', 'ROLENAME', 'PREFIX', 'DETAIL_SM_ARN']:
+    os.environ.setdefault(name, 'benchmark')
+os.environ.setdefault('LOOKBACK', '90')
+from health_events import merge_event_details #pylint: disable=wrong-import-position
+
+EVENT_ARN = 'arn:aws:health:us-east-1::event/EC2/AWS_EC2_OPERATIONAL_ISSUE/benchmark'
+
+
+def jmespath_join(event, details, affected_entities):
+    """ previous implementation: O(entities x details) """
+    event_details_per_affected = []
+    if len(affected_entities) == 0:
+        event = {**event, **details[0]}
+        event_details_per_affected.append(event)
+    for affected_entity in affected_entities:
+        account = affected_entity['awsAccountId']
+        event_arn = affected_entity['eventArn']
+        affected_entity['entityStatusCode'] = affected_entity.pop('statusCode', None)
+        affected_entity['entityLastUpdatedTime'] = affected_entity.pop('lastUpdatedTime', None)
+        detail = jmespath.search(f"[?awsAccountId=='{account}']|[?event.arn=='{event_arn}']", details)
+        for detail_rec in detail:
+            metadata = detail_rec.get('eventMetadata') or {}
+            deprecated_versions = metadata.pop('deprecated_versions', None)
+            if deprecated_versions:
+                event['deprecated_versions'] = deprecated_versions
+            if len(metadata) == 0:
+                event['eventMetadata'] = ""
+        merged_dict = {**event, **affected_entity}
+        if len(detail) > 0:
+            merged_dict = {**merged_dict, **detail[0]}
+        event_details_per_affected.append(merged_dict)
+    return event_details_per_affected
+
+
+def synthetic(accounts, entities):
+    """ an org wide event with `entities` affected entities spread over `accounts` accounts """
+    account_ids = [f'{i:012d}' for i in range(accounts)]
+    event = {'arn': EVENT_ARN, 'eventScopeCode': 'ACCOUNT_SPECIFIC', 'payer_account_id': '999999999999'}
+    details = [{
+        'awsAccountId': account_id,
+        'event': {'arn': EVENT_ARN, 'eventTypeCode': 'AWS_EC2_OPERATIONAL_ISSUE', 'region': 'us-east-1'},
+        'eventDescription': {'latestDescription': 'Increased API error rates'},
+        'eventMetadata': {'deprecated_versions': 'v1'} if i % 10 == 0 else {},
+    } for i, account_id in enumerate(account_ids)]
+    affected_entities = [{
+        'awsAccountId': account_ids[i % accounts],
+        'eventArn': EVENT_ARN,
+        'entityValue': f'i-{i:017x}',
+        'statusCode': 'IMPAIRED',
+        'lastUpdatedTime': '2024-01-01T00:00:00Z',
+    } for i in range(entities)]
+    return event, details, affected_entities
+
+
+def measure(function, data):
+    data = copy.deepcopy(data) # the join updates its input
+    start = time.perf_counter()
+    result = function(*data)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--entities', type=int, default=10000)
+    args = parser.parse_args()
+
+    data = synthetic(args.accounts, args.entities)
+    before, expected = measure(jmespath_join, data)
+    after, result = measure(merge_event_details, data)
+    assert result == expected, 'outputs differ'
+    print(f'{args.entities} entities, {args.accounts} accounts: identical output')
+    print(f'{"jmespath filter":<16} {before:8.3f}s')
+    print(f'{"index":<16} {after:8.3f}s  x{before / after:.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+""" Compare the size and the Athena scan of the output formats of the record writers.
+
+Usage:
+    python benchmarks/output_formats.py inventory-ebs.json [--columns accountid,region,VolumeType,Size]
+    python benchmarks/output_formats.py --synthetic 100000
+
+Athena scans the whole object for JSON formats. For parquet it only scans the
+column chunks of the queried columns, read here from the parquet metadata.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from cid_dc.writers import WRITERS, open_writer #pylint: disable=wrong-import-position
+
+
+def synthetic_volumes(count):
+    """ records shaped like inventory ebs data """
+    for i in range(count):
+        yield {
+            'AvailabilityZone': random.choice(['us-east-1a', 'us-east-1b', 'eu-west-1a']),
+            'CreateTime': '2023-01-01T00:00:00+00:00',
+            'Encrypted': random.choice([True, False]),
+            'Size': random.choice([8, 20, 100, 500]),
+            'SnapshotId': f'snap-{i:017x}',
+            'State': random.choice(['in-use', 'available']),
+            'VolumeId': f'vol-{i:017x}',
+            'Iops': random.choice([100, 3000]),
+            'Tags': [{'Key': 'Name', 'Value': f'volume-{i % 1000}'}],
+            'VolumeType': random.choice(['gp2', 'gp3', 'io1']),
+            'MultiAttachEnabled': False,
+            'Attachments': [{'Device': '/dev/xvda', 'InstanceId': f'i-{i:017x}', 'State': 'attached'}],
+            'accountid': f'{random.randint(0, 50):012d}',
+            'collection_date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'region': 'us-east-1',
+        }
+
+
+def parquet_scan(path, columns):
+    """ bytes read by a query on the given top level columns """
+    import pyarrow.parquet as pq #pylint: disable=import-outside-toplevel
+    metadata = pq.ParquetFile(path).metadata
+    scanned = 0
+    for group in range(metadata.num_row_groups):
+        row_group = metadata.row_group(group)
+        for col in range(row_group.num_columns):
+            chunk = row_group.column(col)
+            if chunk.path_in_schema.split('.')[0] in columns:
+                scanned += chunk.total_compressed_size
+    return scanned
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', nargs='?', help='JSON lines file, ex: an inventory object downloaded from s3')
+    parser.add_argument('--synthetic', type=int, default=0, help='number of synthetic ebs records to use instead of a file')
+    parser.add_argument('--columns', default='accountid,region,VolumeType,Size', help='columns queried in athena')
+    args = parser.parse_args()
+    if args.file:
+        with open(args.file, encoding='utf-8') as file_:
+            records = [json.loads(line) for line in file_ if line.strip()]
+    else:
+        records = list(synthetic_volumes(args.synthetic or 100000))
+    columns = set(args.columns.split(','))
+
+    print(f'{len(records)} records, query columns: {sorted(columns)}')
+    print(f"{'format':10} {'size (bytes)':>14} {'ratio':>7} {'athena scan (bytes)':>20}")
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = None
+        for fmt in WRITERS:
+            path = os.path.join(tmp, 'data' + WRITERS[fmt].extension)
+            try:
+                with open_writer(path, fmt) as writer:
+                    for record in records:
+                        writer.write(record)
+            except ImportError as exc:
+                print(f'{fmt:10} skipped: {exc}')
+                continue
+            size = os.path.getsize(path)
+            baseline = baseline or size
+            scanned = parquet_scan(path, columns) if fmt == 'parquet' else size
+            print(f'{fmt:10} {size:>14} {size / baseline:>7.2f} {scanned:>20}')
+
+
+if __name__ == '__main__':
+    main()
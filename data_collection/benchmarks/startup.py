@@ -0,0 +1,94 @@
+""" Measure the import-to-handler-ready time of each module Lambda: the time to import
+the script in a fresh interpreter until its lambda_handler is available, as in a cold start.
+No AWS call is made: imports must not reach the network.
+
+Usage:
+    python benchmarks/startup.py [--runs 5] [--max-seconds 2]
+
+Exits with 1 if the median of a script is above --max-seconds.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+SCRIPTS = [
+    'account_collector',
+    'budgets',
+    'compute_optimizer',
+    'cost_anomaly',
+    'health_events',
+    'inventory',
+    'organizations',
+    'pricing',
+    'trust_advisor',
+]
+# environment variables read at import time, as set by terraform
+ENVIRONMENT = {
+    'BUCKET_NAME': 'benchmark',
+    'BUCKET_PREFIX': 'benchmark',
+    'CODE_BUCKET': 'benchmark',
+    'DEST_PREFIX': 'benchmark',
+    'PREFIX': 'benchmark',
+    'ROLE_NAME': 'benchmark',
+    'ROLENAME': 'benchmark',
+    'RESOURCE_PREFIX': 'CID-DC-',
+    'MANAGEMENT_ACCOUNT_IDS': '123456789012',
+    'PREDEF_ACCOUNT_LIST_KEY': 'account-list/account-list.json',
+    'LINKED_ACCOUNT_LIST_KEY': 'account-list/linked-account-list.json',
+    'PAYER_ACCOUNT_LIST_KEY': 'account-list/payer-account-list.json',
+    'REGIONS': 'us-east-1',
+    'RDS_GRAVITON_PATH': 'pricing/rds-graviton',
+    'DETAIL_SM_ARN': 'arn:aws:states:us-east-1:123456789012:stateMachine:benchmark',
+    'LOOKBACK': '90',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+}
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+assert callable(module.lambda_handler)
+print(json.dumps(time.perf_counter() - start))
+'''
+
+
+def measure(script):
+    """ seconds from import to handler ready, in a new interpreter """
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE, script],
+        cwd=SCRIPTS_DIR,
+        env={**os.environ, **ENVIRONMENT, 'PYTHONDONTWRITEBYTECODE': '1'},
+        capture_output=True,
+        text=True,
+        check=False,
+        timeout=300,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f'{script}: {result.stderr.strip().splitlines()[-1]}')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    slow = []
+    print(f'{"script":<20} {"median":>9} {"max":>9}')
+    for script in SCRIPTS:
+        timings = [measure(script) for _ in range(args.runs)]
+        median = statistics.median(timings)
+        print(f'{script:<20} {median * 1000:7.0f}ms {max(timings) * 1000:7.0f}ms')
+        if median > args.max_seconds:
+            slow.append(script)
+    if slow:
+        print(f'Above {args.max_seconds}s: {", ".join(slow)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+""" Measure the records/second of the flattening of Trusted Advisor flagged resources:
+the previous per resource zip and rename vs the checks compiled once in trust_advisor.
+
+Usage:
+    python benchmarks/trusted_advisor.py [--records 100000]
+"""
+import os
+import sys
+import copy
+import time
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+for name in ['BUCKET_NAME', 'ROLENAME', 'PREFIX']:
+    os.environ.setdefault(name, 'benchmark')
+import trust_advisor #pylint: disable=wrong-import-position
+
+CHECK = {
+    'id': 'Qch7DwouX1',
+    'name': 'Low Utilization Amazon EC2 Instances',
+    'category': 'cost_optimizing',
+    'metadata': ['Region/AZ', 'Instance ID', 'Instance Name', 'Instance Type', 'Estimated Monthly Savings',
+                 'Day 1', 'Day 2', 'Day 3', '14-Day Average CPU Utilization', 'Number of Days Low Utilization'],
+}
+
+
+def previous_flagged_resources(check, result, account_id, account_name):
+    """ previous trust_advisor.read_ta loop body """
+    dt = result['timestamp']
+    ts = datetime.strptime(dt, '%Y-%m-%dT%H:%M:%SZ').strftime('%s')
+    for resource in result["flaggedResources"]:
+        output = {}
+        if "metadata" in resource:
+            output.update(dict(zip(check["metadata"], resource["metadata"])))
+            del resource['metadata']
+        resource["Region"] = resource.pop("region") if "region" in resource else '-'
+        resource["Status"] = resource.pop("status") if "status" in resource else '-'
+        output.update({"AccountId":account_id, "AccountName":account_name, "Category": check["category"], 'DateTime': dt, 'Timestamp': ts, "CheckName": check["name"], "CheckId": check["id"]})
+        output.update(resource)
+        output = {k.lower(): v for k, v in output.items()}
+        yield output
+
+
+def synthetic_result(count):
+    """ a result shaped like describe_trusted_advisor_check_result """
+    return {
+        'checkId': CHECK['id'],
+        'timestamp': '2024-01-01T00:00:00Z',
+        'status': 'warning',
+        'flaggedResources': [{
+            'status': 'warning',
+            'region': 'us-east-1',
+            'resourceId': f'{i:064x}',
+            'isSuppressed': False,
+            'metadata': ['us-east-1a', f'i-{i:017x}', f'instance-{i}', 'm5.large', '$50.00', '1.2%', '1.5%', '0.9%', '1.1%', '14 days'],
+        } for i in range(count)],
+    }
+
+
+def measure(name, function, count):
+    start = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - start
+    print(f'{name:<28} {count / duration:12,.0f} records/s')
+    return result, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+
+    result = synthetic_result(args.records)
+    previous_result = copy.deepcopy(result) # the previous implementation updates its input
+    expected, before = measure('previous', lambda: list(previous_flagged_resources(CHECK, previous_result, '123456789012', 'benchmark')), args.records)
+    records, after = measure('compiled', lambda: list(trust_advisor.flagged_resources(CHECK, result, '123456789012', 'benchmark')), args.records)
+    assert records == expected, 'outputs differ'
+    print(f'{"":<28} x{before / after:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -66,12 +66,14 @@ resource "aws_lambda_function" "lambda_function_budgets" {
   role          = aws_iam_role.lambda_role_budgets.arn
   memory_size   = 2688
   timeout       = 300
+  layers        = concat(local.module_layers["budgets"], [aws_lambda_layer_version.sdk.arn])
 
   environment {
     variables = {
-      BUCKET_NAME = "cid-data-${data.aws_caller_identity.current.account_id}"
-      PREFIX      = "budgets"
-      ROLE_NAME   = "CID-DC-Optimization-Data-Multi-Account-Role"
+      BUCKET_NAME   = "cid-data-${data.aws_caller_identity.current.account_id}"
+      PREFIX        = "budgets"
+      ROLE_NAME     = "CID-DC-Optimization-Data-Multi-Account-Role"
+      OUTPUT_FORMAT = local.output_format["budgets"]
     }
   }
 }
@@ -89,7 +91,8 @@ resource "aws_glue_crawler" "crawler_budgets" {
   database_name = "optimization_data"
 
   s3_target {
-    path = "s3://cid-data-${data.aws_caller_identity.current.account_id}/budgets/budgets-data/"
+    path       = "s3://cid-data-${data.aws_caller_identity.current.account_id}/budgets/budgets-data/"
+    exclusions = local.output_format_exclusions[local.output_format["budgets"]]
   }
 }
 
@@ -97,13 +100,17 @@ resource "aws_glue_crawler" "crawler_budgets" {
 resource "aws_sfn_state_machine" "sfn_budgets" {
   name     = "CID-DC-budgets-StateMachine"
   role_arn = aws_iam_role.step_function_execution_role.arn
-  definition = templatefile("./definitions/template.asl.json", {
+  definition = templatefile(local.sfn_template["budgets"], {
     "account_id"  = data.aws_caller_identity.current.account_id
     "module_name" = "budgets"
     "type"        = "LINKED"
     "comment"     = "Orchestrate the collection of cost-anomaly data"
     "crawler"     = "CID-DC-budgets-Crawler"
     "params"      = ""
+    "shard_name"  = "budgets"
+    "batch_size"  = local.account_shards["budgets"].batch_size
+    "max_weight"  = local.account_shards["budgets"].max_weight
+    "timeout"     = local.account_shards["budgets"].timeout_seconds
   })
 }
 
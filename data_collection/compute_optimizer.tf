@@ -31,6 +31,21 @@ resource "aws_iam_role" "lambda_role_compute_optimizer" {
       ]
     })
   }
+
+  # size of the exported files, reported when tracking the export jobs
+  inline_policy {
+    name = "S3ExportAccess"
+    policy = jsonencode({
+      Version = "2012-10-17"
+      Statement = [
+        {
+          Effect   = "Allow"
+          Action   = "s3:GetObject"
+          Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}.*/compute_optimizer/*"
+        }
+      ]
+    })
+  }
 }
 
 data "archive_file" "lambda-compute-optimizer" {
@@ -48,6 +63,7 @@ resource "aws_lambda_function" "lambda_function_compute_optimizer" {
   role          = aws_iam_role.lambda_role_compute_optimizer.arn
   memory_size   = 2688
   timeout       = 300
+  layers        = [aws_lambda_layer_version.common.arn, aws_lambda_layer_version.sdk.arn]
 
   environment {
     variables = {
@@ -56,6 +72,8 @@ resource "aws_lambda_function" "lambda_function_compute_optimizer" {
       MANAGEMENT_ACCOUNT_IDS  = var.management_account_id
       ROLE_NAME               = "CID-DC-Lambda-Assume-Role-Management-Account"
       REGIONS                 = var.enabled_regions
+      SKIP_EXISTING           = var.compute_optimizer_skip_existing ? "yes" : "no"
+      TRACK_EXPORTS           = var.compute_optimizer_track_exports ? "yes" : "no"
     }
   }
 }
@@ -52,6 +52,14 @@ resource "aws_iam_role" "lambda_role_cost_anomaly" {
             "s3:ListBucket"
           ]
           Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}"
+        },
+        {
+          Effect = "Allow"
+          Action = [
+            "s3:DeleteObject"
+          ]
+          # the latest state dataset is removed when no anomaly is left in the upsert index
+          Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/cost-anomaly/cost-anomaly-latest/*"
         }
       ]
     })
@@ -74,12 +82,18 @@ resource "aws_lambda_function" "lambda_function_cost_anomaly" {
   role          = aws_iam_role.lambda_role_cost_anomaly.arn
   memory_size   = 2688
   timeout       = 600
+  layers        = local.module_layers["cost-anomaly"]
 
   environment {
     variables = {
-      BUCKET_NAME = "cid-data-${data.aws_caller_identity.current.account_id}"
-      PREFIX      = "cost-anomaly"
-      ROLE_NAME   = "CID-DC-Lambda-Assume-Role-Management-Account"
+      BUCKET_NAME   = "cid-data-${data.aws_caller_identity.current.account_id}"
+      PREFIX        = "cost-anomaly"
+      ROLE_NAME     = "CID-DC-Lambda-Assume-Role-Management-Account"
+      OUTPUT_FORMAT = local.output_format["cost-anomaly"]
+      SPLIT_MODE    = var.cost_anomaly_split_mode
+      WINDOW_DAYS   = var.cost_anomaly_window_days
+      UPSERT_INDEX  = var.cost_anomaly_upsert_index ? "yes" : "no"
+      COMPACT_DAYS  = var.cost_anomaly_compact_days
     }
   }
 }
@@ -97,13 +111,23 @@ resource "aws_glue_crawler" "crawler_cost_anomaly" {
   database_name = "optimization_data"
 
   s3_target {
-    path = "s3://cid-data-${data.aws_caller_identity.current.account_id}/cost-anomaly/cost-anomaly-data/"
+    path       = "s3://cid-data-${data.aws_caller_identity.current.account_id}/cost-anomaly/cost-anomaly-data/"
+    exclusions = local.output_format_exclusions[local.output_format["cost-anomaly"]]
+  }
+
+  # compacted latest state of each anomaly, written with the upsert index
+  dynamic "s3_target" {
+    for_each = var.cost_anomaly_upsert_index ? ["cost-anomaly-latest"] : []
+    content {
+      path       = "s3://cid-data-${data.aws_caller_identity.current.account_id}/cost-anomaly/${s3_target.value}/"
+      exclusions = local.output_format_exclusions[local.output_format["cost-anomaly"]]
+    }
   }
 
   configuration = jsonencode({
     CrawlerOutput = {
       Tables = {
-        TableThreshold = 1
+        TableThreshold = var.cost_anomaly_upsert_index ? 2 : 1
       }
     }
     Grouping = {
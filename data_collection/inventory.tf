@@ -40,9 +40,16 @@ resource "aws_iam_role" "lambda_role_inventory" {
         {
           Effect = "Allow"
           Action = [
-            "s3:PutObject"
+            "s3:PutObject",
+            "s3:AbortMultipartUpload",
+            "s3:GetObject"
           ]
           Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/*"
+        },
+        {
+          Effect   = "Allow"
+          Action   = "s3:ListBucket" # a missing manifest returns NoSuchKey instead of AccessDenied
+          Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}"
         }
       ]
     })
@@ -63,14 +70,20 @@ resource "aws_lambda_function" "lambda_function_inventory" {
   filename      = "./scripts/inventory.zip"
   role          = aws_iam_role.lambda_role_inventory.arn
   memory_size   = 2688
-  timeout       = 300
+  timeout       = var.inventory_combined_collection ? 900 : 300
+  layers        = local.module_layers["inventory"]
 
   environment {
     variables = {
-      BUCKET_NAME = "cid-data-${data.aws_caller_identity.current.account_id}"
-      PREFIX      = "inventory"
-      ROLENAME    = "CID-DC-Optimization-Data-Multi-Account-Role"
-      REGIONS     = var.enabled_regions
+      BUCKET_NAME          = "cid-data-${data.aws_caller_identity.current.account_id}"
+      PREFIX               = "inventory"
+      ROLENAME             = "CID-DC-Optimization-Data-Multi-Account-Role"
+      REGIONS              = var.enabled_regions
+      MAX_REGION_WORKERS   = 8
+      OUTPUT_FORMAT        = local.output_format["inventory"]
+      DELTA_MODE           = var.inventory_delta_mode ? "yes" : "no"
+      # a baseline every inventory_baseline_period_runs runs, with half a schedule interval of margin for late runs
+      BASELINE_PERIOD_DAYS = var.inventory_baseline_period_runs * local.inventory_schedule_days - floor(local.inventory_schedule_days / 2)
     }
   }
 }
@@ -82,6 +95,7 @@ resource "aws_cloudwatch_log_group" "log_group_inventory" {
 
 ##################### GLUE CRAWLER #####################
 locals {
+  inventory_schedule_days = 14
   inventory_map = {
     AMI                 = "ami"
     Ec2Instances        = "ec2-instances"
@@ -92,7 +106,7 @@ locals {
     RdsDbInstances      = "rds-db-instances"
     RdsDbSnapshots      = "rds-db-snapshots"
     VpcInstances        = "vpc"
-    EBS                 = "inventory"
+    EBS                 = "ebs"
     EKSClusters         = "eks"
     Snapshot            = "snapshot"
   }
@@ -106,7 +120,8 @@ resource "aws_glue_crawler" "crawler_inventory" {
   database_name = "optimization_data"
 
   s3_target {
-    path = "s3://cid-data-${data.aws_caller_identity.current.account_id}/inventory/inventory-${each.value}-data/"
+    path       = "s3://cid-data-${data.aws_caller_identity.current.account_id}/inventory/inventory-${each.value}-data/"
+    exclusions = local.output_format_exclusions[local.output_format["inventory"]]
   }
 
   configuration = jsonencode({
@@ -127,12 +142,34 @@ resource "aws_sfn_state_machine" "sfn_inventory" {
   for_each = local.inventory_map
   name     = "CID-DC-inventory-${each.key}-StateMachine"
   role_arn = aws_iam_role.step_function_execution_role.arn
-  definition = templatefile("./definitions/template.asl.json", {
+  definition = templatefile(local.sfn_template["inventory-${each.key}"], {
     "account_id"  = data.aws_caller_identity.current.account_id
     "module_name" = "inventory"
     "type"        = "LINKED"
     "crawler"     = "CID-DC-inventory-${each.key}-Crawler"
     "params"      = "${each.value}"
+    "shard_name"  = "inventory-${each.key}"
+    "batch_size"  = local.account_shards["inventory-${each.key}"].batch_size
+    "max_weight"  = local.account_shards["inventory-${each.key}"].max_weight
+    "timeout"     = local.account_shards["inventory-${each.key}"].timeout_seconds
+  })
+}
+
+# Single state machine collecting all sub modules in one Lambda invocation per account
+resource "aws_sfn_state_machine" "sfn_inventory_combined" {
+  count    = var.inventory_combined_collection ? 1 : 0
+  name     = "CID-DC-inventory-StateMachine"
+  role_arn = aws_iam_role.step_function_execution_role.arn
+  definition = templatefile(local.sfn_template["inventory"], {
+    "account_id"  = data.aws_caller_identity.current.account_id
+    "module_name" = "inventory"
+    "type"        = "LINKED"
+    "crawler"     = join(",", [for key in keys(local.inventory_map) : "CID-DC-inventory-${key}-Crawler"])
+    "params"      = join(" ", values(local.inventory_map))
+    "shard_name"  = "inventory"
+    "batch_size"  = local.account_shards["inventory"].batch_size
+    "max_weight"  = local.account_shards["inventory"].max_weight
+    "timeout"     = local.account_shards["inventory"].timeout_seconds
   })
 }
 
@@ -143,8 +180,8 @@ resource "aws_scheduler_schedule" "schedule_inventory" {
   description         = "Scheduler for the ODC inventory ${each.key} module"
   name                = "${local.resource_prefix}inventory-${each.key}-RefreshSchedule"
   group_name          = "default"
-  schedule_expression = "rate(14 days)"
-  state               = "ENABLED"
+  schedule_expression = "rate(${local.inventory_schedule_days} days)"
+  state               = var.inventory_combined_collection ? "DISABLED" : "ENABLED"
 
   flexible_time_window {
     mode                      = "FLEXIBLE"
@@ -156,3 +193,23 @@ resource "aws_scheduler_schedule" "schedule_inventory" {
     role_arn = aws_iam_role.scheduler_execution_role.arn
   }
 }
+
+resource "aws_scheduler_schedule" "schedule_inventory_combined" {
+  count = var.inventory_combined_collection ? 1 : 0
+
+  description         = "Scheduler for the ODC inventory module (all sub modules)"
+  name                = "${local.resource_prefix}inventory-RefreshSchedule"
+  group_name          = "default"
+  schedule_expression = "rate(${local.inventory_schedule_days} days)"
+  state               = "ENABLED"
+
+  flexible_time_window {
+    mode                      = "FLEXIBLE"
+    maximum_window_in_minutes = 30
+  }
+
+  target {
+    arn      = aws_sfn_state_machine.sfn_inventory_combined[0].arn
+    role_arn = aws_iam_role.scheduler_execution_role.arn
+  }
+}
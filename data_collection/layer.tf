@@ -0,0 +1,64 @@
+##################### SHARED LAYER #####################
+# Python helpers shared by the module Lambdas (./scripts/cid_dc)
+data "archive_file" "lambda-layer-common" {
+  type        = "zip"
+  output_path = "./build/cid_dc_layer.zip"
+
+  dynamic "source" {
+    for_each = fileset("./scripts/cid_dc", "*.py")
+    content {
+      content  = file("./scripts/cid_dc/${source.value}")
+      filename = "python/cid_dc/${source.value}"
+    }
+  }
+}
+
+resource "aws_lambda_layer_version" "common" {
+  layer_name          = "${local.resource_prefix}common-Layer"
+  description         = "Helpers shared by the data collection Lambdas"
+  filename            = data.archive_file.lambda-layer-common.output_path
+  source_code_hash    = data.archive_file.lambda-layer-common.output_base64sha256
+  compatible_runtimes = ["python3.10", "python3.12"]
+}
+
+##################### SDK LAYER #####################
+# boto3 pinned in ./layers/sdk/requirements.txt for the modules calling APIs missing from the
+# boto3 of the Lambda runtime, instead of pip installing it on each cold start. The build runs
+# on every plan and only calls pip when ./build/sdk-layer is missing or outdated (requires python3 with pip)
+data "external" "sdk_layer_build" {
+  program = ["python3", "./layers/sdk/build.py"]
+  query = {
+    requirements = "./layers/sdk/requirements.txt"
+    target       = "./build/sdk-layer"
+  }
+}
+
+data "archive_file" "lambda-layer-sdk" {
+  type        = "zip"
+  source_dir  = data.external.sdk_layer_build.result.path
+  output_path = "./build/sdk_layer.zip"
+  excludes    = [".requirements.sha256"]
+}
+
+resource "aws_lambda_layer_version" "sdk" {
+  layer_name          = "${local.resource_prefix}sdk-Layer"
+  description         = "boto3 required by the budgets and compute optimizer Lambdas"
+  filename            = data.archive_file.lambda-layer-sdk.output_path
+  source_code_hash    = data.archive_file.lambda-layer-sdk.output_base64sha256
+  compatible_runtimes = ["python3.10", "python3.12"]
+}
+
+locals {
+  # the pyarrow layer is only added to the modules writing parquet
+  module_layers = {
+    for module, format in local.output_format :
+    module => concat(
+      [aws_lambda_layer_version.common.arn],
+      format == "parquet" && var.parquet_layer_arn != "" ? [var.parquet_layer_arn] : []
+    )
+  }
+  pricing_layers = concat(
+    [aws_lambda_layer_version.common.arn],
+    contains([for transform in values(var.pricing_transforms) : transform.format], "parquet") && var.parquet_layer_arn != "" ? [var.parquet_layer_arn] : []
+  )
+}
@@ -0,0 +1,42 @@
+""" Build the sdk Lambda layer, for the terraform external data source of layer.tf
+
+Reads {"requirements": path, "target": dir} on stdin, makes sure `target`/python holds the
+packages of `requirements` and prints {"path": target, "requirements_hash": ...}.
+The packages are installed with pip only when the directory is missing or was built
+from other requirements, so every plan (fresh checkout, CI runner) gets the directory.
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+
+STAMP = '.requirements.sha256'
+
+
+def main():
+    query = json.load(sys.stdin)
+    requirements, target = query['requirements'], query['target']
+    with open(requirements, 'rb') as file_:
+        requirements_hash = hashlib.sha256(file_.read()).hexdigest()
+    stamp = os.path.join(target, STAMP)
+    try:
+        with open(stamp, encoding='utf-8') as file_:
+            built = file_.read().strip() == requirements_hash
+    except OSError:
+        built = False
+    if not built:
+        shutil.rmtree(target, ignore_errors=True)
+        subprocess.run(
+            [sys.executable, '-m', 'pip', 'install', '-r', requirements, '--target', os.path.join(target, 'python'),
+             '--no-cache-dir', '--no-compile', '--disable-pip-version-check', '--quiet'],
+            check=True, stdout=sys.stderr, # stdout is reserved for the result
+        )
+        with open(stamp, 'w', encoding='utf-8') as file_:
+            file_.write(requirements_hash)
+    json.dump({'path': target, 'requirements_hash': requirements_hash}, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -65,12 +65,15 @@ resource "aws_lambda_function" "lambda_function_organizations" {
   role          = aws_iam_role.lambda_role_organizations.arn
   memory_size   = 2688
   timeout       = 600
+  layers        = local.module_layers["organizations"]
 
   environment {
     variables = {
-      BUCKET_NAME = "cid-data-${data.aws_caller_identity.current.account_id}"
-      PREFIX      = "organizations"
-      ROLENAME    = "CID-DC-Lambda-Assume-Role-Management-Account"
+      BUCKET_NAME      = "cid-data-${data.aws_caller_identity.current.account_id}"
+      PREFIX           = "organizations"
+      ROLENAME         = "CID-DC-Lambda-Assume-Role-Management-Account"
+      OUTPUT_FORMAT    = local.output_format["organizations"]
+      OU_TREE_PREFETCH = "yes"
     }
   }
 }
@@ -87,7 +90,8 @@ resource "aws_glue_crawler" "crawler_organizations" {
   database_name = "optimization_data"
 
   s3_target {
-    path = "s3://cid-data-${data.aws_caller_identity.current.account_id}/organizations/organization-data/"
+    path       = "s3://cid-data-${data.aws_caller_identity.current.account_id}/organizations/organization-data/"
+    exclusions = local.output_format_exclusions[local.output_format["organizations"]]
   }
 }
 
@@ -30,6 +30,29 @@ resource "aws_iam_role" "lambda_role_pricing" {
           ]
           Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/*"
         },
+        {
+          Effect = "Allow"
+          Action = [
+            "s3:AbortMultipartUpload",
+            "s3:DeleteObject"
+          ]
+          Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/pricing/*"
+        },
+        {
+          Effect = "Allow"
+          Action = [
+            "s3:GetObject"
+          ]
+          Resource = [
+            "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/pricing/pricing-versions/*",
+            "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/pricing/pricing-cache/*"
+          ]
+        },
+        {
+          Effect   = "Allow"
+          Action   = "s3:ListBucket"
+          Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}"
+        },
         {
           Effect = "Allow"
           Action = [
@@ -71,17 +94,22 @@ resource "aws_lambda_function" "lambda_function_pricing" {
   runtime       = "python3.10"
   handler       = "pricing.lambda_handler"
   filename      = "./scripts/pricing.zip"
-  role          = aws_iam_role.lambda_role_trusted_advisor.arn
+  role          = aws_iam_role.lambda_role_pricing.arn
   memory_size   = 2880
   timeout       = 600
+  layers        = local.pricing_layers
 
   environment {
     variables = {
-      BUCKET_NAME       = "cid-data-${data.aws_caller_identity.current.account_id}"
-      CODE_BUCKET       = "aws-managed-cost-intelligence-dashboards-us-east-1"
-      DEST_PREFIX       = "pricing"
-      RDS_GRAVITON_PATH = "cfn/data-collection/data/rds_graviton_mapping.csv"
-      REGIONS           = "us-east-1"
+      BUCKET_NAME        = "cid-data-${data.aws_caller_identity.current.account_id}"
+      CODE_BUCKET        = "aws-managed-cost-intelligence-dashboards-us-east-1"
+      DEST_PREFIX        = "pricing"
+      RDS_GRAVITON_PATH  = "cfn/data-collection/data/rds_graviton_mapping.csv"
+      REGIONS            = "us-east-1"
+      MAX_WORKERS        = 4
+      OFFERS_CACHE_TTL   = 3600
+      OFFERS_CACHE_S3    = "yes"
+      PRICING_TRANSFORMS = jsonencode(local.pricing_transforms)
     }
   }
 }
@@ -383,6 +411,18 @@ resource "aws_sfn_state_machine" "sfn_pricing_RegionNames" {
 #TODO - Add scheduler for each crawler
 
 ##################### GLUE TABLES #####################
+locals {
+  pricing_parquet = {
+    for service, value in local.ServicesMapPricing : value.path => try(var.pricing_transforms[value.path].format, "csv") == "parquet"
+  }
+  pricing_fields = {
+    for service, value in local.ServicesMapPricing : value.path => [
+      for field in value.fields : field
+      if length(try(var.pricing_transforms[value.path].columns, [])) == 0 || contains([for column in try(var.pricing_transforms[value.path].columns, []) : lower(column)], field.Name)
+    ]
+  }
+}
+
 resource "aws_glue_catalog_table" "pricing" {
   for_each      = local.ServicesMapPricing
   depends_on    = [aws_glue_catalog_database.glue_database]
@@ -390,28 +430,33 @@ resource "aws_glue_catalog_table" "pricing" {
   name          = "pricing_${each.value.path}_data"
 
   table_type = "EXTERNAL_TABLE"
-  parameters = {
+  parameters = local.pricing_parquet[each.value.path] ? {
+    "classification" = "parquet"
+    } : {
     "classification"  = "csv"
     "compressionType" = "none"
   }
 
   storage_descriptor {
     number_of_buckets = -1
+    # CSV columns are mapped by position, so the table only lists the columns kept by the transform
     dynamic "columns" {
-      for_each = each.value.fields
+      for_each = local.pricing_fields[each.value.path]
 
       content {
         name = columns.value.Name
         type = columns.value.Type
       }
     }
-    input_format  = "org.apache.hadoop.mapred.TextInputFormat"
-    output_format = "org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat"
+    input_format  = local.pricing_parquet[each.value.path] ? "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat" : "org.apache.hadoop.mapred.TextInputFormat"
+    output_format = local.pricing_parquet[each.value.path] ? "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat" : "org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat"
     location      = "s3://cid-data-${data.aws_caller_identity.current.account_id}/pricing/pricing-${each.value.path}-data/"
 
     ser_de_info {
-      serialization_library = "org.apache.hadoop.hive.serde2.OpenCSVSerde"
-      parameters = {
+      serialization_library = local.pricing_parquet[each.value.path] ? "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe" : "org.apache.hadoop.hive.serde2.OpenCSVSerde"
+      parameters = local.pricing_parquet[each.value.path] ? {
+        "serialization.format" = "1"
+        } : {
         "separatorChar"        = ","
         "quoteChar"            = "\""
         "serialization.format" = "1"
@@ -427,4 +472,12 @@ resource "aws_glue_catalog_table" "pricing" {
     }
   }
 
+  lifecycle {
+    precondition {
+      condition = alltrue([
+        for column in try(var.pricing_transforms[each.value.path].columns, []) : contains([for field in each.value.fields : field.Name], lower(column))
+      ])
+      error_message = "pricing_transforms[\"${each.value.path}\"].columns must be columns of the pricing_${each.value.path}_data table: ${join(", ", [for field in each.value.fields : field.Name])}."
+    }
+  }
 }
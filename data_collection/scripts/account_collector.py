@@ -1,8 +1,14 @@
 import os
 import json
 import logging
+from datetime import datetime
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.exceptions import ClientError
+
+from cid_dc.sts import broker
+from cid_dc.org_snapshot import read_snapshot, write_snapshot
 
 ROLE_NAME = os.environ['ROLE_NAME']
 RESOURCE_PREFIX = os.environ['RESOURCE_PREFIX']
@@ -12,6 +18,8 @@ PREDEF_ACCOUNT_LIST_KEY = os.environ['PREDEF_ACCOUNT_LIST_KEY']
 LINKED_ACCOUNT_LIST_KEY = os.environ['LINKED_ACCOUNT_LIST_KEY']
 PAYER_ACCOUNT_LIST_KEY = os.environ['PAYER_ACCOUNT_LIST_KEY']
 TMP_FILE = "/tmp/data.json"
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8')) # payers listed concurrently
+ACCOUNT_LIST_PREFIX = LINKED_ACCOUNT_LIST_KEY.rsplit('/', 1)[0] # shards, weights and run results are stored next to the account lists
 
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
@@ -39,6 +47,9 @@ def lambda_handler(event, context):  # pylint: disable=unused-argument
         raise Exception(f"Lambda event must have 'Type' parameter with value = ({list(functions.keys())})")  # pylint: disable=broad-exception-raised
 
     account_iterator = functions[account_type]
+    shards = event.get('Shards')
+    if shards:
+        account_iterator = partial(iterate_shards, account_iterator, shards)
 
     with open(TMP_FILE, "w") as f:
         count = 0
@@ -54,32 +65,59 @@ def lambda_handler(event, context):  # pylint: disable=unused-argument
         raise Exception('No accounts found. Check the log.')  # pylint: disable=broad-exception-raised
 
     key = LINKED_ACCOUNT_LIST_KEY if account_type == 'linked' else PAYER_ACCOUNT_LIST_KEY
+    if shards:
+        key = f"{ACCOUNT_LIST_PREFIX}/shards/{shards['Name']}.json"
     s3 = boto3.client('s3')
     s3.upload_file(TMP_FILE, Bucket=BUCKET, Key=key)
+    broker.log_stats()
 
-    return {'statusCode': 200, 'accountList': key, 'bucket': BUCKET}
+    res = {'statusCode': 200, 'accountList': key, 'bucket': BUCKET}
+    if shards:
+        res['resultsPrefix'] = results_prefix(shards['Name'])
+    return res
 
 def get_all_payers():
     for payer_id in MANAGEMENT_ACCOUNT_IDS.split(','):
         yield payer_id.strip()
 
-def iterate_admins_accounts(service=None):
+def get_delegated_admins(service, payer_ids):
+    """ returns {payer_id: delegated admin account id} from ssm, reading up to 10 parameters per call """
     ssm = boto3.client('ssm')
-    for payer_id in get_all_payers():
-        account_id = payer_id  # Default
-        if service:
-            ssm_key = f'/cid/{RESOURCE_PREFIX}config/delegated-admin/{service}/{payer_id}'
-            try:
-                account_id = ssm.get_parameter(Name=ssm_key)['Parameter']['Value']
-            except ssm.exceptions.ParameterNotFound:
-                logger.warning(f'Not found ssm parameter {ssm_key}. Will use Management Account Id {payer_id}')
+    names = {f'/cid/{RESOURCE_PREFIX}config/delegated-admin/{service}/{payer_id}': payer_id for payer_id in payer_ids}
+    admins = {}
+    batch_names = list(names)
+    for index in range(0, len(batch_names), 10):
+        resp = ssm.get_parameters(Names=batch_names[index:index + 10])
+        for parameter in resp['Parameters']:
+            admins[names[parameter['Name']]] = parameter['Value']
+        for ssm_key in resp['InvalidParameters']:
+            logger.warning(f'Not found ssm parameter {ssm_key}. Will use Management Account Id {names[ssm_key]}')
+    return admins
+
+def iterate_admins_accounts(service=None):
+    payer_ids = list(get_all_payers())
+    admins = get_delegated_admins(service, payer_ids) if service else {}
+    for payer_id in payer_ids:
+        account_id = admins.get(payer_id, payer_id)  # Default is the Management Account
         yield {"account": json.dumps({'account_id': account_id, 'account_name': '', 'payer_id': payer_id})}
 
+def list_payer_accounts(org_account, s3):
+    """ returns the active accounts of a payer organization, from the snapshot if fresh """
+    accounts = read_snapshot(s3, BUCKET, org_account['payer_id'])
+    if accounts is None:
+        organizations = get_client_with_role(service="organizations", account_id=org_account['account_id'], region="us-east-1")  # MUST be us-east-1
+        accounts = [account for page in organizations.get_paginator("list_accounts").paginate() for account in page['Accounts']]
+        write_snapshot(s3, BUCKET, org_account['payer_id'], accounts)
+    return [
+        format_account(account.get('Id'), account.get('Name'), org_account['payer_id'])
+        for account in accounts if account.get('Status') == 'ACTIVE'
+    ]
+
 def iterate_linked_accounts():
     defined_accounts, ext = get_defined_list(BUCKET, PREDEF_ACCOUNT_LIST_KEY)
-    try:
-        if defined_accounts:
-            logger.info(f'Using defined account list instead of payer organization')
+    if defined_accounts:
+        logger.info(f'Using defined account list instead of payer organization')
+        try:
             for account_data in defined_accounts:
                 if ext == "json":
                     account = json.loads(account_data)
@@ -87,15 +125,84 @@ def iterate_linked_accounts():
                 else:
                     account = account_data.split(',')
                     yield format_account(account[0], account[1], account[2])
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            logger.error(f'{PREDEF_ACCOUNT_LIST_KEY}: {exc}')
+        return
+    logger.info(f'Using payer organization for the account list')
+    s3 = boto3.client('s3')
+    org_accounts = [json.loads(org_account_data['account']) for org_account_data in iterate_admins_accounts('organizations')]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [(org_account, executor.submit(list_payer_accounts, org_account, s3)) for org_account in org_accounts]
+        for org_account, future in futures:  # in payer order, so the account list is deterministic
+            try:
+                yield from future.result()
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                logger.error(f'{org_account}: {exc}')  # other payers are still listed
+
+def results_prefix(name):
+    """ where the state machine writes the results (account durations) of the shards """
+    return f"{ACCOUNT_LIST_PREFIX}/results/{name}"
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def update_weights(s3, name):
+    """ returns {account_id: weight}, updated with the account durations (seconds) of the
+    previous runs written by the Distributed Map ResultWriter. Results are deleted once read.
+    """
+    weights_key = f"{ACCOUNT_LIST_PREFIX}/weights/{name}.json"
+    try:
+        weights = json.loads(s3.get_object(Bucket=BUCKET, Key=weights_key)['Body'].read())
+    except ClientError:
+        weights = {}
+    objects = [
+        obj for page in s3.get_paginator('list_objects_v2').paginate(Bucket=BUCKET, Prefix=results_prefix(name) + '/')
+        for obj in page.get('Contents', [])
+    ]
+    for obj in sorted(objects, key=lambda obj: obj['LastModified']): # the most recent run wins
+        if not obj['Key'].rsplit('/', 1)[-1].startswith('SUCCEEDED_'):
+            continue
+        for execution in json.loads(s3.get_object(Bucket=BUCKET, Key=obj['Key'])['Body'].read()):
+            for result in json.loads(execution.get('Output') or '[]'):
+                account_id = json.loads(result['account'])['account_id']
+                weights[account_id] = (parse_time(result['end']) - parse_time(result['start'])).total_seconds()
+    if objects:
+        s3.put_object(Bucket=BUCKET, Key=weights_key, Body=json.dumps(weights))
+        for index in range(0, len(objects), 1000):
+            s3.delete_objects(Bucket=BUCKET, Delete={'Objects': [{'Key': obj['Key']} for obj in objects[index:index + 1000]]})
+    return weights
+
+def make_shards(accounts, weights, batch_size, max_weight):
+    """ groups accounts in shards of up to batch_size accounts and max_weight, heaviest accounts first
+    (first fit decreasing). Accounts of max_weight or more get their own shard. Accounts without
+    weight (new accounts or first run) may be slow: they get max_weight, so their own shard too.
+    """
+    items = []
+    for account in accounts:
+        account_id = json.loads(account['account'])['account_id']
+        items.append((weights.get(account_id, max_weight), account_id, account))
+    items.sort(key=lambda item: (-item[0], item[1])) # deterministic
+    shards = []
+    for weight, _, account in items:
+        for shard in shards:
+            if len(shard['accounts']) < batch_size and shard['weight'] + weight <= max_weight:
+                break
         else:
-            logger.info(f'Using payer organization for the account list')
-            for org_account_data in iterate_admins_accounts('organizations'):
-                org_account = json.loads(org_account_data['account'])
-                organizations = get_client_with_role(service="organizations", account_id=org_account['account_id'], region="us-east-1")  # MUST be us-east-1
-                for account in organizations.get_paginator("list_accounts").paginate().search("Accounts[?Status=='ACTIVE']"):
-                    yield format_account(account.get('Id'), account.get('Name'), org_account['payer_id'])
-    except Exception as exc:  # pylint: disable=broad-exception-caught
-        logger.error(f'{org_account}: {exc}')
+            shard = {'weight': 0, 'accounts': []}
+            shards.append(shard)
+        shard['accounts'].append(account)
+        shard['weight'] += weight
+    return shards
+
+def iterate_shards(account_iterator, shards):
+    """ yields cost-weighted shards of the accounts """
+    accounts = list(account_iterator())
+    if not accounts:
+        return
+    weights = update_weights(boto3.client('s3'), shards['Name'])
+    items = make_shards(accounts, weights, int(shards.get('BatchSize', 25)), float(shards.get('MaxWeight', 300)))
+    logger.info(f'{len(accounts)} accounts in {len(items)} shards, {len(weights)} accounts with a weight')
+    yield from items
 
 def get_defined_list(bucket, key):
     s3 = boto3.client("s3")
@@ -119,14 +226,4 @@ def format_account(account_id, account_name, payer_id):
     }
 
 def get_client_with_role(account_id, service, region):
-    credentials = boto3.client('sts').assume_role(
-        RoleArn=f"arn:aws:iam::{account_id}:role/{ROLE_NAME}",
-        RoleSessionName="data_collection"
-    )['Credentials']
-    return boto3.client(
-        service,
-        region_name=region,
-        aws_access_key_id=credentials['AccessKeyId'],
-        aws_secret_access_key=credentials['SecretAccessKey'],
-        aws_session_token=credentials['SessionToken'],
-    )
+    return broker.client(account_id, ROLE_NAME, service, region)
@@ -6,23 +6,27 @@ import json
 import logging
 import datetime
 from json import JSONEncoder
-import sys
+from concurrent.futures import ThreadPoolExecutor
 
-# update boto3 for list_tags_for_resource api
-from pip._internal import main
-main(['install', '-I', '-q', 'boto3', '--target', '/tmp/', '--no-cache-dir', '--disable-pip-version-check'])
-sys.path.insert(0,'/tmp/')
-
-import boto3 #pylint: disable=C0413
+# list_tags_for_resource needs a boto3 newer than the one of the runtime: it comes with the sdk layer (layers/sdk)
+import boto3
+from cid_dc.sts import broker
+from cid_dc.writers import open_writer, extension
+from cid_dc.throttle import AdaptiveTokenBucket, call_with_backoff
 
 BUCKET = os.environ["BUCKET_NAME"]
 PREFIX = os.environ["PREFIX"]
 ROLE_NAME = os.environ['ROLE_NAME']
 TMP_FILE = "/tmp/data.json"
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'json')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+BUDGETS_API_RATE = float(os.environ.get('BUDGETS_API_RATE', '5'))
 
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
 
+limiter = AdaptiveTokenBucket(BUDGETS_API_RATE)
+
 class DateTimeEncoder(JSONEncoder):
     """encoder for json with time object"""
     def default(self, o):
@@ -31,16 +35,7 @@ class DateTimeEncoder(JSONEncoder):
         return None
 
 def assume_role(account_id, service, region):
-    cred = boto3.client('sts', region_name=region).assume_role(
-        RoleArn=f"arn:aws:iam::{account_id}:role/{ROLE_NAME}",
-        RoleSessionName="data_collection"
-    )['Credentials']
-    return boto3.client(
-        service,
-        aws_access_key_id=cred['AccessKeyId'],
-        aws_secret_access_key=cred['SecretAccessKey'],
-        aws_session_token=cred['SessionToken']
-    )
+    return broker.client(account_id, ROLE_NAME, service, region)
 
 def lambda_handler(event, context): #pylint: disable=W0613
     logger.info(f"Event data {json.dumps(event)}")
@@ -58,35 +53,38 @@ def lambda_handler(event, context): #pylint: disable=W0613
 
     logger.info(f"Collecting data for account: {account_id}")
     budgets_client = assume_role(account_id, "budgets", "us-east-1") # must be us-east-1
-    count = 0
-    with open(TMP_FILE, "w", encoding='utf-8') as f:
-        for budget in budgets_client.get_paginator("describe_budgets").paginate(AccountId=account_id).search('Budgets'):
-            if not budget: continue
-            budget['collection_time'] = collection_time
+    def get_tags(budget):
+        """ Fetch tags for the budget using List tag for resource API """
+        arn = f"arn:{aws_partition}:budgets::{account_id}:budget/{budget['BudgetName']}"
+        return call_with_backoff(limiter, budgets_client.list_tags_for_resource, ResourceARN=arn).get('ResourceTags') or []
 
-            # Fetch tags for the budget using List tag for resource API
-            budget_name = budget['BudgetName']
-            budget_tags = budgets_client.list_tags_for_resource(ResourceARN=f"arn:{aws_partition}:budgets::{account_id}:budget/{budget_name}")
-            budget.update({
-                'Account_ID': account_id,
-                'Account_Name': account_name,
-                'Tags': budget_tags.get('ResourceTags') or []
-            })
+    with open_writer(TMP_FILE, OUTPUT_FORMAT, serializer=lambda rec: json.dumps(rec, cls=DateTimeEncoder)) as writer, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for page in budgets_client.get_paginator("describe_budgets").paginate(AccountId=account_id):
+            budgets = [budget for budget in page.get('Budgets') or [] if budget]
+            # tags of a page are fetched concurrently and budgets written in their original order
+            for budget, tags in zip(budgets, executor.map(get_tags, budgets)):
+                budget['collection_time'] = collection_time
+                budget.update({
+                    'Account_ID': account_id,
+                    'Account_Name': account_name,
+                    'Tags': tags
+                })
 
-            # Fetch CostFilters if available
-            if 'CostFilters' not in budget or len(budget['CostFilters']) == 0 or 'PlannedBudgetLimits' not in budget:
-                budget.update({'CostFilters': {'Filter': ['None']}})
+                # Fetch CostFilters if available
+                if 'CostFilters' not in budget or len(budget['CostFilters']) == 0 or 'PlannedBudgetLimits' not in budget:
+                    budget.update({'CostFilters': {'Filter': ['None']}})
 
-            f.write(json.dumps(budget, cls=DateTimeEncoder) + "\n")
-            count += 1
-    logger.info(f"Budgets collected: {count}")
-    s3_upload(account_id, payer_id)
+                writer.write(budget)
+    logger.info(f"Budgets collected: {writer.count}")
+    s3_upload(account_id, payer_id, writer.count)
+    broker.log_stats()
 
 
-def s3_upload(account_id, payer_id):
-    if os.path.getsize(TMP_FILE) == 0:
+def s3_upload(account_id, payer_id, count):
+    if count == 0:
         logger.info(f"No data in file for {PREFIX}")
         return
-    key = datetime.datetime.now().strftime(f"{PREFIX}/{PREFIX}-data/payer_id={payer_id}/year=%Y/month=%m/budgets-{account_id}.json")
+    key = datetime.datetime.now().strftime(f"{PREFIX}/{PREFIX}-data/payer_id={payer_id}/year=%Y/month=%m/budgets-{account_id}{extension(OUTPUT_FORMAT)}")
     boto3.client('s3').upload_file(TMP_FILE, BUCKET, key)
     logger.info(f"Budget data for {account_id} stored at s3://{BUCKET}/{key}")
@@ -0,0 +1,3 @@
+""" Helpers shared by the data collection Lambdas.
+Deployed as a Lambda layer (see layer.tf) and importable as `cid_dc` from the scripts folder.
+"""
@@ -0,0 +1,52 @@
+""" Collection checkpoints
+
+The last successful collection window of a module and payer is stored in one
+small s3 object, so the next run finds where to start with a single GET
+instead of listing the data prefix:
+
+    checkpoint = read_checkpoint(s3, bucket, 'cost-anomaly', payer_id)
+    start = checkpoint['end'] if checkpoint else fallback_from_listing()
+    ... collect and upload ...
+    write_checkpoint(s3, bucket, 'cost-anomaly', payer_id, start, end)
+
+A checkpoint is written with a single put_object after the upload, so readers
+see either the previous or the new window, never a partial one.
+"""
+import os
+import json
+import logging
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+CHECKPOINT_PREFIX = os.environ.get('CHECKPOINT_PREFIX', 'checkpoints')
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
+
+
+def checkpoint_key(module, payer_id):
+    return f'{CHECKPOINT_PREFIX}/{module}/payer_id={payer_id}.json'
+
+
+def read_checkpoint(s3, bucket, module, payer_id):
+    """ returns {'start', 'end', 'updated_at'} (ISO strings) of the last successful collection or None """
+    try:
+        checkpoint = json.loads(s3.get_object(Bucket=bucket, Key=checkpoint_key(module, payer_id))['Body'].read())
+    except ClientError as exc: # AccessDenied if missing and the role cannot list the bucket
+        logger.info(f'No checkpoint for {module} {payer_id}: {exc.response["Error"]["Code"]}')
+        return None
+    logger.info(f'Checkpoint of {module} {payer_id}: {checkpoint["start"]} to {checkpoint["end"]}')
+    return checkpoint
+
+
+def write_checkpoint(s3, bucket, module, payer_id, start, end):
+    """ records the window (dates or datetimes) collected and uploaded successfully """
+    checkpoint = {
+        'module': module,
+        'payer_id': payer_id,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'updated_at': datetime.now(timezone.utc).isoformat(),
+    }
+    s3.put_object(Bucket=bucket, Key=checkpoint_key(module, payer_id), Body=json.dumps(checkpoint))
@@ -0,0 +1,72 @@
+""" Record flattening
+
+A Flattener compiles a mapping {output field: source path} once into accessor
+functions and then flattens records with plain dict and list lookups:
+
+    flatten = Flattener({
+        'account_id': 'awsAccountId',
+        'event_code': 'event.eventTypeCode',
+        'linked_account': 'RootCauses.0.LinkedAccount',
+        'impact_percentage': {'path': 'Impact.TotalImpactPercentage', 'default': 0.0, 'type': float},
+    })
+    flatten(record) # -> {'account_id': ..., 'event_code': ..., ...}
+
+Paths are separated by '.' or '/'. A numeric part is a list index, or a key if
+the value is a dict. Missing keys, out of range indexes and values of the wrong
+type give the default (None unless set). `type` converts values that are not None.
+"""
+import re
+
+
+def compile_path(path, default=None):
+    """ returns a function getting the value at `path` of a record, or `default` """
+    parts = [(part, int(part) if part.isdigit() else None) for part in re.split(r'[./]', path)]
+    if len(parts) == 1 and parts[0][1] is None:
+        key = parts[0][0]
+        def get_key(record):
+            if isinstance(record, dict) and key in record:
+                return record[key]
+            return default
+        return get_key
+
+    def get_path(record):
+        current = record
+        for key, index in parts:
+            if isinstance(current, dict) and key in current:
+                current = current[key]
+            elif index is not None and isinstance(current, list) and index < len(current):
+                current = current[index]
+            else:
+                return default
+        return current
+    return get_path
+
+
+def compile_field(spec):
+    """ returns the accessor of a field spec: a path or {'path', 'default', 'type'} """
+    if isinstance(spec, str):
+        return compile_path(spec)
+    default = spec.get('default')
+    get = compile_path(spec['path'], default)
+    convert = spec.get('type')
+    if convert is None:
+        return get
+    def get_converted(record):
+        value = get(record)
+        return default if value is None else convert(value)
+    return get_converted
+
+
+class Flattener():
+    """ Flattens records according to a mapping compiled once """
+    def __init__(self, mapping):
+        self.fields = list(mapping)
+        self.accessors = [(name, compile_field(spec)) for name, spec in mapping.items()]
+
+    def __call__(self, record):
+        return {name: get(record) for name, get in self.accessors}
+
+    def flatten_all(self, records):
+        """ flattens a list of records """
+        accessors = self.accessors
+        return [{name: get(record) for name, get in accessors} for record in records]
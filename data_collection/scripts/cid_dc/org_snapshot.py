@@ -0,0 +1,67 @@
+""" Organization snapshot
+
+The account list of each payer organization is stored once in s3, so the
+account collector of every module does not list the organization again:
+
+    accounts = read_snapshot(s3, bucket, payer_id)
+    if accounts is None: # missing, stale or of another version
+        accounts = list(...)
+        write_snapshot(s3, bucket, payer_id, accounts)
+
+Snapshots are written by the organizations module and by the account
+collector, and are used while younger than ORG_SNAPSHOT_TTL seconds
+(0 disables them).
+"""
+import os
+import json
+import time
+import logging
+
+from botocore.exceptions import ClientError
+
+SNAPSHOT_VERSION = 1 # snapshots of another version are ignored
+SNAPSHOT_TTL = int(os.environ.get('ORG_SNAPSHOT_TTL', '21600'))
+SNAPSHOT_PREFIX = os.environ.get('ORG_SNAPSHOT_PREFIX', 'account-list/org-snapshot')
+FIELDS = ['Id', 'Name', 'Status']
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
+
+
+def snapshot_key(payer_id):
+    return f'{SNAPSHOT_PREFIX}/payer_id={payer_id}.json'
+
+
+def read_snapshot(s3, bucket, payer_id, ttl=SNAPSHOT_TTL):
+    """ returns the accounts of the payer snapshot or None if missing, stale or of another version """
+    if ttl <= 0:
+        return None
+    try:
+        snapshot = json.loads(s3.get_object(Bucket=bucket, Key=snapshot_key(payer_id))['Body'].read())
+    except ClientError as exc: # AccessDenied if missing and the role cannot list the bucket
+        logger.debug(f'No organization snapshot for {payer_id}: {exc}')
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        logger.info(f'Ignoring organization snapshot of {payer_id} with version {snapshot.get("version")}')
+        return None
+    age = time.time() - snapshot['created_at']
+    if age > ttl:
+        logger.info(f'Organization snapshot of {payer_id} is stale ({int(age)}s)')
+        return None
+    logger.info(f'Using organization snapshot of {payer_id} ({len(snapshot["accounts"])} accounts, {int(age)}s old)')
+    return snapshot['accounts']
+
+
+def write_snapshot(s3, bucket, payer_id, accounts):
+    """ stores the accounts (list_accounts records) of the payer organization """
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created_at': time.time(),
+        'payer_id': payer_id,
+        'accounts': [{field: account.get(field) for field in FIELDS} for account in accounts],
+    }
+    try:
+        s3.put_object(Bucket=bucket, Key=snapshot_key(payer_id), Body=json.dumps(snapshot))
+        logger.info(f'Stored organization snapshot of {payer_id} ({len(accounts)} accounts)')
+    except ClientError as exc:
+        logger.warning(f'Cannot store organization snapshot of {payer_id}: {exc}')
@@ -0,0 +1,129 @@
+""" Streaming S3 sink
+
+S3MultipartSink is a binary file object that buffers written bytes into parts
+and uploads them with a multipart upload while the caller keeps writing, so
+collected data does not need to be staged in /tmp. Objects smaller than one
+part are sent with a single put_object, and nothing is uploaded when nothing
+was written. On error the multipart upload is aborted.
+
+    with S3MultipartSink(bucket, key) as sink:
+        with GzipJsonLinesWriter(sink) as writer:
+            writer.write(record)
+"""
+import io
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+PART_SIZE = int(os.environ.get('S3_PART_SIZE_MB', '16')) * 1024 * 1024 # min 5MB
+MAX_UPLOAD_WORKERS = int(os.environ.get('S3_UPLOAD_WORKERS', '4'))
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
+
+
+class S3MultipartSink(io.RawIOBase):
+    """ Write-only file object uploading to s3://bucket/key """
+    def __init__(self, bucket, key, s3_client=None, part_size=PART_SIZE, max_workers=MAX_UPLOAD_WORKERS):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.s3 = s3_client or boto3.client('s3')
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.size = 0
+        self.uploaded = False
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_workers * 2) # bounds memory held by pending parts
+        self._max_workers = max_workers
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed sink')
+        self._buffer.extend(data)
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _submit_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        part_number = len(self._parts) + 1
+        self._slots.acquire() #pylint: disable=consider-using-with
+        future = self._executor.submit(self._upload_part, part_number, body)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._parts.append(future)
+
+    def _upload_part(self, part_number, body):
+        res = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        logger.debug(f'Uploaded part {part_number} of s3://{self.bucket}/{self.key}')
+        return {'PartNumber': part_number, 'ETag': res['ETag']}
+
+    def close(self):
+        """ upload remaining data and complete the upload """
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                if self._buffer:
+                    self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+                    self.uploaded = True
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._parts]
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={'Parts': parts},
+                )
+                self.uploaded = True
+            self._buffer = bytearray()
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._shutdown()
+            super().close()
+
+    def abort(self):
+        """ discard the data and abort the multipart upload if started """
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            self._shutdown()
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+                logger.info(f'Aborted upload of s3://{self.bucket}/{self.key}')
+            except Exception as exc: #pylint: disable=broad-exception-caught
+                logger.error(f'Cannot abort upload of s3://{self.bucket}/{self.key}: {exc}')
+            self._upload_id = None
+        super().close()
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
@@ -0,0 +1,114 @@
+""" Credential broker shared by all collectors
+
+Assumed role sessions are cached per (account, role) at module level, so they
+are reused by all clients of an invocation and across warm invocations of the
+same Lambda container. botocore refreshes the credentials shortly before they
+expire, so a cached session never hands out expired credentials.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import boto3
+import botocore.session
+from botocore.credentials import RefreshableCredentials
+
+SESSION_NAME = "data_collection"
+CACHE_SIZE = int(os.environ.get('CREDENTIALS_CACHE_SIZE', '1000'))
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
+
+
+class CredentialBroker():
+    """ Cache of assumed role sessions and their clients """
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
+        self._sessions = OrderedDict() # (account_id, role_name) -> {'session': ..., 'clients': {...}}
+        self._key_locks = {}
+        self._lock = threading.RLock()
+        self._sts = None
+
+    def _sts_client(self):
+        with self._lock:
+            if self._sts is None:
+                # a dedicated session as the default boto3 session is not thread safe
+                self._sts = boto3.session.Session().client('sts', region_name=os.environ.get('AWS_REGION'))
+            return self._sts
+
+    def _assume_role(self, account_id, role_name):
+        """ returns credentials in the format expected by RefreshableCredentials """
+        credentials = self._sts_client().assume_role(
+            RoleArn=f"arn:aws:iam::{account_id}:role/{role_name}",
+            RoleSessionName=SESSION_NAME,
+        )['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+
+    def _refresh(self, account_id, role_name):
+        logger.debug(f'Refreshing credentials of {role_name} in {account_id}')
+        with self._lock:
+            self.stats['refreshes'] += 1
+        return self._assume_role(account_id, role_name)
+
+    def _create_session(self, account_id, role_name):
+        credentials = RefreshableCredentials.create_from_metadata(
+            metadata=self._assume_role(account_id, role_name),
+            refresh_using=lambda: self._refresh(account_id, role_name),
+            method='sts-assume-role',
+        )
+        botocore_session = botocore.session.get_session()
+        botocore_session._credentials = credentials #pylint: disable=protected-access
+        return boto3.session.Session(botocore_session=botocore_session)
+
+    def _entry(self, account_id, role_name):
+        key = (account_id, role_name)
+        with self._lock:
+            if key in self._sessions:
+                self.stats['hits'] += 1
+                self._sessions.move_to_end(key)
+                return self._sessions[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock: # only one thread assumes a given role, others wait for its session
+            with self._lock:
+                if key in self._sessions:
+                    self.stats['hits'] += 1
+                    return self._sessions[key]
+            logger.debug(f'Assuming role {role_name} in {account_id}')
+            entry = {'session': self._create_session(account_id, role_name), 'clients': {}}
+            with self._lock:
+                self.stats['misses'] += 1
+                self._sessions[key] = entry
+                while len(self._sessions) > self.cache_size:
+                    evicted, _ = self._sessions.popitem(last=False)
+                    self._key_locks.pop(evicted, None)
+            return entry
+
+    def session(self, account_id, role_name):
+        """ returns a boto3 session of the role assumed in the account """
+        return self._entry(account_id, role_name)['session']
+
+    def client(self, account_id, role_name, service, region=None, config=None):
+        """ returns a client of the role assumed in the account. Clients are cached as well """
+        entry = self._entry(account_id, role_name)
+        key = (service, region, config)
+        with self._lock: # boto3 sessions are not thread safe
+            if key not in entry['clients']:
+                entry['clients'][key] = entry['session'].client(service, region_name=region, config=config)
+            return entry['clients'][key]
+
+    def log_stats(self):
+        """ log cache counters """
+        logger.info(
+            f"Credentials cache: hits={self.stats['hits']} misses={self.stats['misses']} "
+            f"refreshes={self.stats['refreshes']} cached={len(self._sessions)}"
+        )
+
+
+broker = CredentialBroker()
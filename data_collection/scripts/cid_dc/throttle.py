@@ -0,0 +1,92 @@
+""" Client side rate limiting
+
+TokenBucket spreads the API calls of concurrent workers so they stay under a
+service quota instead of being throttled and retried:
+
+    limiter = TokenBucket(rate=10, burst=10)
+    limiter.acquire() # blocks until a token is available
+    client.list_tags_for_resource(ResourceId=id_)
+
+AdaptiveTokenBucket also lowers its rate when the service throttles and raises
+it back on success. call_with_backoff retries throttled calls with jittered
+exponential backoff:
+
+    limiter = AdaptiveTokenBucket(rate=10)
+    call_with_backoff(limiter, client.describe_events_for_organization, filter=...)
+"""
+import time
+import random
+import logging
+import threading
+
+from botocore.exceptions import ClientError
+
+THROTTLING_ERRORS = ['Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException', 'RequestLimitExceeded']
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket():
+    """ Thread safe token bucket: `rate` tokens per second, up to `burst` tokens """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """ wait until `tokens` are available and take them """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """ Token bucket halving its rate on throttling (down to `min_rate`) and increasing it
+    by `increase` tokens per second on each success (up to the initial rate)
+    """
+    def __init__(self, rate, burst=None, min_rate=0.5, increase=0.1):
+        super().__init__(rate, burst)
+        self.max_rate = self.rate
+        self.min_rate = min_rate
+        self.increase = increase
+
+    def throttled(self):
+        """ the service throttled a call """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        """ a call succeeded """
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+def call_with_backoff(limiter, function, max_attempts=8, base_delay=0.5, max_delay=20, **kwargs):
+    """ calls function(**kwargs) within the limiter, retrying throttled calls with jittered exponential backoff """
+    for attempt in range(max_attempts):
+        limiter.acquire()
+        try:
+            result = function(**kwargs)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] not in THROTTLING_ERRORS or attempt == max_attempts - 1:
+                raise
+            if isinstance(limiter, AdaptiveTokenBucket):
+                limiter.throttled()
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            logger.debug(f'Throttled, retrying in {delay:.1f}s (rate {limiter.rate:.1f}/s)')
+            time.sleep(delay)
+            continue
+        if isinstance(limiter, AdaptiveTokenBucket):
+            limiter.succeeded()
+        return result
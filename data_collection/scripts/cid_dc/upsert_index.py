@@ -0,0 +1,115 @@
+""" Upsert index
+
+Records collected again on every run (open cost anomalies for instance) are
+written only when they are new or changed. The index of a module and payer is
+one gzipped s3 object mapping each record id to a hash of the fields that can
+change, and to the latest version of the record:
+
+    index = read_index(s3, bucket, 'cost-anomaly', payer_id)
+    for record in records:
+        if index.update(record['AnomalyId'], record):
+            writer.write(record) # new or changed
+    ... upload ...
+    write_index(s3, bucket, 'cost-anomaly', payer_id, index)
+
+The latest versions give the compacted "latest state" dataset (index.records())
+without reading back the daily files. Records that cannot change anymore are
+dropped when compacting, so the index does not grow without limit:
+
+    index.compacted(keep=lambda record: record['AnomalyEndDate'] is None)
+"""
+import os
+import gzip
+import json
+import hashlib
+import logging
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+INDEX_PREFIX = os.environ.get('INDEX_PREFIX', 'indexes')
+INDEX_VERSION = 1
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
+
+
+def index_key(module, payer_id):
+    return f'{INDEX_PREFIX}/{module}/payer_id={payer_id}.json.gz'
+
+
+def record_hash(record, fields):
+    """ returns a short stable hash of the `fields` of a record """
+    values = json.dumps([record.get(field) for field in fields], default=str)
+    return hashlib.sha1(values.encode('utf-8')).hexdigest()[:16]
+
+
+class UpsertIndex():
+    """ {record id: (hash of `fields`, latest record)} """
+    def __init__(self, fields, entries=None, compacted_at=None):
+        self.fields = list(fields)
+        self.entries = entries or {}
+        self.compacted_at = compacted_at
+        self.changed = 0
+
+    def update(self, id_, record):
+        """ stores the record and returns True if it is new or its fields changed """
+        hash_ = record_hash(record, self.fields)
+        previous = self.entries.get(id_)
+        self.entries[id_] = {'hash': hash_, 'record': record}
+        if previous is not None and previous['hash'] == hash_:
+            return False
+        self.changed += 1
+        return True
+
+    def records(self):
+        """ latest version of all records, sorted by id """
+        return [self.entries[id_]['record'] for id_ in sorted(self.entries)]
+
+    def compaction_due(self, interval_days):
+        """ True if the latest state dataset was not written in the last `interval_days` """
+        if not self.compacted_at:
+            return True
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(self.compacted_at)
+        return age.total_seconds() >= interval_days * 86400
+
+    def compacted(self, keep=None):
+        """ marks the latest state as written now, after dropping the records for which `keep` is False.
+        Returns the number of records dropped
+        """
+        dropped = [id_ for id_, entry in self.entries.items() if keep is not None and not keep(entry['record'])]
+        for id_ in dropped:
+            del self.entries[id_]
+        if dropped:
+            logger.info(f'Dropped {len(dropped)} records from the index')
+        self.compacted_at = datetime.now(timezone.utc).isoformat()
+        return len(dropped)
+
+
+def read_index(s3, bucket, module, payer_id, fields):
+    """ returns the UpsertIndex of the module and payer, empty if missing or built on other fields """
+    try:
+        body = s3.get_object(Bucket=bucket, Key=index_key(module, payer_id))['Body'].read()
+    except ClientError as exc: # AccessDenied if missing and the role cannot list the bucket
+        logger.info(f'No index for {module} {payer_id}: {exc.response["Error"]["Code"]}')
+        return UpsertIndex(fields)
+    data = json.loads(gzip.decompress(body))
+    if data.get('version') != INDEX_VERSION or data.get('fields') != list(fields):
+        logger.info(f'Index of {module} {payer_id} is outdated, rebuilding it')
+        return UpsertIndex(fields)
+    logger.info(f'Index of {module} {payer_id}: {len(data["entries"])} records')
+    return UpsertIndex(fields, data['entries'], data.get('compacted_at'))
+
+
+def write_index(s3, bucket, module, payer_id, index):
+    """ stores the index, with a single put_object """
+    data = {
+        'version': INDEX_VERSION,
+        'fields': index.fields,
+        'compacted_at': index.compacted_at,
+        'updated_at': datetime.now(timezone.utc).isoformat(),
+        'entries': index.entries,
+    }
+    body = gzip.compress(json.dumps(data, default=str).encode('utf-8'))
+    s3.put_object(Bucket=bucket, Key=index_key(module, payer_id), Body=body)
+    logger.info(f'Index of {module} {payer_id} stored: {len(index.entries)} records, {index.changed} new or changed')
@@ -0,0 +1,257 @@
+""" Record writers
+
+Collectors write their records through a writer selected per module with the
+OUTPUT_FORMAT environment variable:
+ - json     JSON lines (default)
+ - json.gz  gzip compressed JSON lines
+ - parquet  Parquet with row groups of PARQUET_ROW_GROUP_SIZE rows. Requires pyarrow
+            (for instance from the AWS SDK for pandas Lambda layer). Without a `schema`
+            all columns are strings (nested values as JSON), so the files of a table
+            have the same column types whatever values they hold
+ - csv      CSV with a header line, for tabular data with fixed `fieldnames`
+ - csv.gz   gzip compressed CSV
+
+Writers work on binary file objects, so they can target a local file or an
+S3MultipartSink streaming to s3 (see open_s3_writer).
+"""
+import io
+import os
+import csv
+import json
+import gzip
+import logging
+
+from cid_dc.sinks import S3MultipartSink
+
+ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', '100000'))
+
+logger = logging.getLogger(__name__)
+logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
+
+
+class RecordWriter():
+    """ Base writer: serializes records with `serializer` and counts them """
+    extension = ''
+
+    def __init__(self, fileobj, serializer=json.dumps, close_fileobj=False):
+        self.fileobj = fileobj
+        self.raw_fileobj = fileobj
+        self.serializer = serializer
+        self.close_fileobj = close_fileobj
+        self.count = 0
+
+    def write(self, record):
+        """ write one record """
+        self._write(record)
+        self.count += 1
+
+    def _write(self, record):
+        raise NotImplementedError
+
+    def close(self):
+        """ flush and close the underlying file if owned """
+        if self.close_fileobj:
+            if self.count == 0 and hasattr(self.raw_fileobj, 'abort'):
+                self.raw_fileobj.abort() # no empty objects (a gzip header only) on s3
+            else:
+                self._close()
+                self.raw_fileobj.close()
+        else:
+            self._close()
+
+    def _close(self):
+        """ flush the format specific data """
+
+    def abort(self):
+        """ discard the output if the underlying file supports it (streams), else close it """
+        if hasattr(self.raw_fileobj, 'abort'):
+            self.raw_fileobj.abort()
+        elif self.close_fileobj:
+            self.raw_fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class JsonLinesWriter(RecordWriter):
+    """ JSON lines """
+    extension = '.json'
+
+    def _write(self, record):
+        self.fileobj.write((self.serializer(record) + '\n').encode('utf-8'))
+
+
+class GzipJsonLinesWriter(JsonLinesWriter):
+    """ gzip compressed JSON lines """
+    extension = '.json.gz'
+
+    def __init__(self, fileobj, serializer=json.dumps, close_fileobj=False):
+        super().__init__(fileobj, serializer, close_fileobj)
+        self.fileobj = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6)
+
+    def _close(self):
+        self.fileobj.close() # writes the gzip trailer, does not close the raw file
+
+
+class CsvWriter(RecordWriter):
+    """ CSV with a header line. Records are dicts or sequences ordered like `fieldnames`.
+    Without `fieldnames`, the keys of the first record are used.
+    """
+    extension = '.csv'
+
+    def __init__(self, fileobj, serializer=json.dumps, close_fileobj=False, fieldnames=None):
+        super().__init__(fileobj, serializer, close_fileobj)
+        self.fieldnames = fieldnames
+        self.text = None
+        self.csv = None
+
+    def _write(self, record):
+        if self.csv is None:
+            self.fieldnames = self.fieldnames or list(record)
+            self.text = io.TextIOWrapper(self.fileobj, encoding='utf-8', newline='', write_through=True)
+            self.csv = csv.writer(self.text, quoting=csv.QUOTE_ALL, lineterminator='\n')
+            self.csv.writerow(self.fieldnames)
+        if isinstance(record, dict):
+            record = [record.get(name) for name in self.fieldnames]
+        self.csv.writerow(record)
+
+    def _close(self):
+        if self.text is not None:
+            self.text.flush()
+            self.text.detach() # keeps the binary file open
+            self.text = None
+        self.fileobj.flush()
+
+
+class GzipCsvWriter(CsvWriter):
+    """ gzip compressed CSV """
+    extension = '.csv.gz'
+
+    def __init__(self, fileobj, serializer=json.dumps, close_fileobj=False, fieldnames=None):
+        super().__init__(fileobj, serializer, close_fileobj, fieldnames)
+        self.fileobj = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6)
+
+    def _close(self):
+        super()._close()
+        self.fileobj.close()
+
+
+class ParquetWriter(RecordWriter):
+    """ Parquet. Records are buffered and written on close, so that the schema
+    covers all keys and types found in the records.
+
+    With a `schema` ([(name, type)], type being string, double or bigint), records are
+    dicts or sequences ordered like the schema, and each row group is written as soon as
+    it is full, so memory does not grow with the number of records.
+    """
+    extension = '.parquet'
+
+    def __init__(self, fileobj, serializer=json.dumps, close_fileobj=False, row_group_size=ROW_GROUP_SIZE, schema=None):
+        super().__init__(fileobj, serializer, close_fileobj)
+        self.row_group_size = row_group_size
+        self.schema = schema
+        self.rows = []
+        self.parquet = None
+
+    def _write(self, record):
+        if self.schema is None:
+            # round trip through the module serializer so values match the JSON output (dates as strings etc)
+            self.rows.append(json.loads(self.serializer(record)))
+            return
+        if isinstance(record, dict):
+            record = [record.get(name) for name, _ in self.schema]
+        self.rows.append(record)
+        if len(self.rows) >= self.row_group_size:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        import pyarrow as pa #pylint: disable=import-outside-toplevel
+        import pyarrow.parquet as pq #pylint: disable=import-outside-toplevel
+        columns = {}
+        for index, (name, type_) in enumerate(self.schema):
+            convert = CONVERTERS.get(type_, str)
+            values = [row[index] for row in self.rows]
+            if type_ != 'string':
+                values = [None if value in (None, '') else convert(value) for value in values]
+            columns[name] = pa.array(values, type=pa.type_for_alias(ARROW_TYPES.get(type_, 'string')))
+        table = pa.table(columns)
+        if self.parquet is None:
+            self.parquet = pq.ParquetWriter(self.fileobj, table.schema, compression='snappy')
+        self.parquet.write_table(table)
+        self.rows = []
+
+    def _close(self):
+        if self.schema is not None:
+            if self.rows:
+                self._write_row_group()
+            if self.parquet is not None:
+                self.parquet.close()
+                self.parquet = None
+        elif self.rows:
+            import pyarrow.parquet as pq #pylint: disable=import-outside-toplevel
+            pq.write_table(self.to_table(self.rows), self.fileobj, row_group_size=self.row_group_size, compression='snappy')
+            self.rows = []
+
+    @staticmethod
+    def to_table(rows):
+        """ returns a pyarrow table of string columns with the union of the keys of all rows.
+        Strings are kept as is, other values are stored as JSON. The type of a column does not
+        depend on the values of a file (all null, mixed...), so crawlers see one schema per table.
+        """
+        import pyarrow as pa #pylint: disable=import-outside-toplevel
+        names = list(dict.fromkeys(key for row in rows for key in row))
+        columns = {}
+        for name in names:
+            values = [row.get(name) for row in rows]
+            columns[name] = pa.array([to_string(value) for value in values], type=pa.string())
+        return pa.table(columns)
+
+
+def to_string(value):
+    """ parquet value of a schema-less column """
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+# Athena column types supported by ParquetWriter schemas
+CONVERTERS = {'string': str, 'double': float, 'bigint': int}
+ARROW_TYPES = {'string': 'string', 'double': 'float64', 'bigint': 'int64'}
+
+WRITERS = {
+    'json': JsonLinesWriter,
+    'json.gz': GzipJsonLinesWriter,
+    'parquet': ParquetWriter,
+    'csv': CsvWriter,
+    'csv.gz': GzipCsvWriter,
+}
+
+
+def get_writer_class(fmt):
+    """ returns the writer class of the output format """
+    if fmt not in WRITERS:
+        raise ValueError(f"Unsupported output format '{fmt}'. Supported: {list(WRITERS)}")
+    return WRITERS[fmt]
+
+
+def extension(fmt):
+    """ returns the file extension of the output format, ex: '.json.gz' """
+    return get_writer_class(fmt).extension
+
+
+def open_writer(path, fmt='json', serializer=json.dumps, **kwargs):
+    """ opens a writer on a local file. kwargs are passed to the writer class """
+    return get_writer_class(fmt)(open(path, 'wb'), serializer=serializer, close_fileobj=True, **kwargs) #pylint: disable=consider-using-with
+
+
+def open_s3_writer(bucket, key, fmt='json', serializer=json.dumps, s3_client=None, **kwargs):
+    """ opens a writer streaming to s3://bucket/key. The object is only created if records were written
+    and the upload is aborted if the `with` block raises. kwargs are passed to the writer class.
+    """
+    return get_writer_class(fmt)(S3MultipartSink(bucket, key, s3_client), serializer=serializer, close_fileobj=True, **kwargs)
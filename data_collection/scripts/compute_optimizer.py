@@ -1,27 +1,35 @@
 import os
 import json
+import time
 import logging
 from datetime import date
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
-# update boto3 version
-import sys
-from pip._internal import main
-main(['install', '-I', '-q', 'boto3', '--target', '/tmp/', '--no-cache-dir', '--disable-pip-version-check'])
-sys.path.insert(0,'/tmp/')
+import boto3
 
-import boto3 #pylint: disable=wrong-import-position
+# the export apis need a boto3 newer than the one of the runtime: it comes with the sdk layer (layers/sdk)
+from cid_dc.sts import broker
+from cid_dc.throttle import AdaptiveTokenBucket, call_with_backoff
 
 BUCKET_PREFIX = os.environ["BUCKET_PREFIX"]
 INCLUDE_MEMBER_ACCOUNTS = os.environ.get("INCLUDE_MEMBER_ACCOUNTS", 'yes').lower() == 'yes'
 REGIONS = [r.strip() for r in os.environ.get("REGIONS").split(',') if r]
 ROLE_NAME = os.environ['ROLE_NAME']
 ARCH = os.environ.get('ARCH', 'AWS_ARM64,CURRENT').split(',')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+SKIP_EXISTING = os.environ.get('SKIP_EXISTING', 'no').lower() == 'yes' # skip the exports already done this month
+TRACK_EXPORTS = os.environ.get('TRACK_EXPORTS', 'no').lower() == 'yes' # wait for the export jobs and report them
+TRACK_MARGIN = int(os.environ.get('TRACK_MARGIN', '30')) # seconds kept before the Lambda timeout when tracking
+POLL_INTERVAL = int(os.environ.get('POLL_INTERVAL', '15'))
+CO_API_RATE = float(os.environ.get('CO_API_RATE', '5'))
 
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
 
-def lambda_handler(event, context): #pylint: disable=unused-argument
+limiter = AdaptiveTokenBucket(CO_API_RATE)
+
+def lambda_handler(event, context):
     logger.info(f"Event data {json.dumps(event)}")
     if 'account' not in event:
         raise ValueError(
@@ -33,48 +41,127 @@ def lambda_handler(event, context): #pylint: disable=unused-argument
     try:
         result_messages = []
         error_messages = []
-        for region in REGIONS:
-            credentials = boto3.client('sts', region_name=region).assume_role(
-                RoleArn=f"arn:aws:iam::{payer_id}:role/{ROLE_NAME}",
-                RoleSessionName="data_collection"
-            )["Credentials"]
-            co = boto3.client(
-                "compute-optimizer",
-                region_name=region,
-                aws_access_key_id=credentials['AccessKeyId'],
-                aws_secret_access_key=credentials['SecretAccessKey'],
-                aws_session_token=credentials['SessionToken'],
-            )
-            export_funcs = {
-                'ec2_instance': partial(co.export_ec2_instance_recommendations, recommendationPreferences={'cpuVendorArchitectures': ARCH}),
-                'auto_scale':   partial(co.export_auto_scaling_group_recommendations, recommendationPreferences={'cpuVendorArchitectures': ARCH}),
-                'lambda':       co.export_lambda_function_recommendations,
-                'ebs_volume':   co.export_ebs_volume_recommendations,
-                'ecs_service':  co.export_ecs_service_recommendations,
-                'license':      co.export_license_recommendations,
-                'rds_database': partial(co.export_rds_database_recommendations, recommendationPreferences={'cpuVendorArchitectures': ARCH}),
-            }
-            bucket = BUCKET_PREFIX + '.' + region
-            logger.info(f"INFO: bucket={bucket}")
-            for name, func in export_funcs.items():
-                try:
-                    res = func(
-                        includeMemberAccounts=INCLUDE_MEMBER_ACCOUNTS,
-                        s3DestinationConfig={
-                            'bucket': bucket,
-                            'keyPrefix': date.today().strftime(
-                                f'compute_optimizer/compute_optimizer_{name}/payer_id={payer_id}/year=%Y/month=%-m'
-                            ),
-                        }
-                    )
-                    result_messages.append(f"{region} {name} export queued. JobId: {res['jobId']}")
-                except co.exceptions.LimitExceededException:
-                    result_messages.append(f"{region} {name} export is already in progress.")
-                except Exception as exc: #pylint: disable=broad-exception-caught
-                    error_messages.append(f"ERROR: {region} {name} - {exc}")
+        jobs = {}
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, max(len(REGIONS), 1))) as executor:
+            # regions are submitted concurrently and reported in the order of REGIONS
+            for region, (results, errors, region_jobs) in zip(REGIONS, executor.map(partial(export_region, payer_id), REGIONS)):
+                result_messages += results
+                error_messages += errors
+                if region_jobs:
+                    jobs[region] = region_jobs
         if result_messages:
             logger.info("Success:\n"+"\n".join(result_messages))
+        total = len(result_messages) + len(error_messages)
+        if TRACK_EXPORTS and jobs:
+            error_messages += track_exports(payer_id, jobs, context.get_remaining_time_in_millis() / 1000 - TRACK_MARGIN)
         if error_messages:
-            raise Exception(f"There were {len(error_messages)} errors, out of {len(result_messages) + len(error_messages)} exports: \n" + "\n".join(error_messages)) #pylint: disable=broad-exception-raised
+            raise Exception(f"There were {len(error_messages)} errors, out of {total} exports: \n" + "\n".join(error_messages)) #pylint: disable=broad-exception-raised
     except Exception as exc: #pylint: disable=broad-exception-caught
         logger.error(f"Error {type(exc).__name__} with message {exc}")
+    broker.log_stats()
+
+def export_region(payer_id, region):
+    """ submits the exports of a region, returns (result messages, error messages, {job id: name}) """
+    result_messages = []
+    error_messages = []
+    jobs = {}
+    co = broker.client(payer_id, ROLE_NAME, "compute-optimizer", region)
+    export_funcs = {
+        'ec2_instance': partial(co.export_ec2_instance_recommendations, recommendationPreferences={'cpuVendorArchitectures': ARCH}),
+        'auto_scale':   partial(co.export_auto_scaling_group_recommendations, recommendationPreferences={'cpuVendorArchitectures': ARCH}),
+        'lambda':       co.export_lambda_function_recommendations,
+        'ebs_volume':   co.export_ebs_volume_recommendations,
+        'ecs_service':  co.export_ecs_service_recommendations,
+        'license':      co.export_license_recommendations,
+        'rds_database': partial(co.export_rds_database_recommendations, recommendationPreferences={'cpuVendorArchitectures': ARCH}),
+    }
+    bucket = BUCKET_PREFIX + '.' + region
+    logger.info(f"INFO: bucket={bucket}")
+    existing = []
+    if SKIP_EXISTING or TRACK_EXPORTS:
+        try:
+            existing = recent_jobs(co, bucket)
+        except Exception as exc: #pylint: disable=broad-exception-caught
+            logger.warning(f"{region}: cannot list export jobs: {exc}")
+    for name, func in export_funcs.items():
+        key_prefix = date.today().strftime(f'compute_optimizer/compute_optimizer_{name}/payer_id={payer_id}/year=%Y/month=%-m')
+        previous = jobs_under(existing, key_prefix)
+        complete = [job for job in previous if job['status'] == 'Complete']
+        if SKIP_EXISTING and complete:
+            result_messages.append(f"{region} {name} export skipped, already exported this month. JobId: {complete[0]['jobId']}")
+            continue
+        try:
+            res = func(
+                includeMemberAccounts=INCLUDE_MEMBER_ACCOUNTS,
+                s3DestinationConfig={
+                    'bucket': bucket,
+                    'keyPrefix': key_prefix,
+                }
+            )
+            result_messages.append(f"{region} {name} export queued. JobId: {res['jobId']}")
+            jobs[res['jobId']] = name
+        except co.exceptions.LimitExceededException:
+            result_messages.append(f"{region} {name} export is already in progress.")
+            for job in previous:
+                if job['status'] in ('Queued', 'InProgress'):
+                    jobs[job['jobId']] = name # tracked as the job of this run
+        except Exception as exc: #pylint: disable=broad-exception-caught
+            error_messages.append(f"ERROR: {region} {name} - {exc}")
+    return result_messages, error_messages, jobs
+
+def recent_jobs(co, bucket):
+    """ returns the export jobs of the last days (the api keeps 7 days) to the bucket, newest first """
+    jobs = []
+    params = {}
+    while True:
+        response = call_with_backoff(limiter, co.describe_recommendation_export_jobs, **params)
+        jobs += [job for job in response.get('recommendationExportJobs', []) if job.get('destination', {}).get('s3', {}).get('bucket') == bucket]
+        if not response.get('nextToken'):
+            break
+        params = {'nextToken': response['nextToken']}
+    return sorted(jobs, key=lambda job: job['creationTimestamp'], reverse=True)
+
+def jobs_under(jobs, key_prefix):
+    """ returns the jobs exporting under key_prefix: files are written in <keyPrefix>/compute-optimizer/<account id>/ """
+    return [job for job in jobs if job['destination']['s3'].get('key', '').startswith(key_prefix + '/')]
+
+def track_exports(payer_id, jobs, timeout):
+    """ polls the export jobs {region: {job id: name}} until they finish or for timeout seconds,
+    logs the duration and size of each and returns error messages for the failed ones
+    """
+    deadline = time.monotonic() + timeout
+    pending = {region: dict(region_jobs) for region, region_jobs in jobs.items()}
+    finished = []
+    while pending:
+        for region in list(pending):
+            co = broker.client(payer_id, ROLE_NAME, "compute-optimizer", region)
+            response = call_with_backoff(limiter, co.describe_recommendation_export_jobs, jobIds=list(pending[region]))
+            for job in response.get('recommendationExportJobs', []):
+                if job['status'] in ('Complete', 'Failed'):
+                    finished.append((region, pending[region].pop(job['jobId']), job))
+            if not pending[region]:
+                del pending[region]
+        if not pending or time.monotonic() + POLL_INTERVAL > deadline:
+            break
+        time.sleep(POLL_INTERVAL)
+
+    error_messages = []
+    for region, name, job in finished:
+        duration = (job['lastUpdatedTimestamp'] - job['creationTimestamp']).total_seconds()
+        if job['status'] == 'Failed':
+            error_messages.append(f"ERROR: {region} {name} export failed after {duration:.0f}s - {job.get('failureReason')}")
+            continue
+        logger.info(f"{region} {name} export complete in {duration:.0f}s, {export_size(job)} bytes. JobId: {job['jobId']}")
+    for region, region_jobs in pending.items():
+        for job_id, name in region_jobs.items():
+            logger.warning(f"{region} {name} export not finished after {timeout:.0f}s, it continues in the background. JobId: {job_id}")
+    return error_messages
+
+def export_size(job):
+    """ returns the size of the exported file or None if it cannot be read """
+    destination = job['destination']['s3']
+    try:
+        return boto3.client('s3').head_object(Bucket=destination['bucket'], Key=destination['key'])['ContentLength']
+    except Exception as exc: #pylint: disable=broad-exception-caught
+        logger.debug(f"Cannot read the size of s3://{destination['bucket']}/{destination['key']}: {exc}")
+        return None
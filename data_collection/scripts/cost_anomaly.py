@@ -2,18 +2,38 @@ import os
 import json
 import logging
 from datetime import date, timedelta, datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 
+from cid_dc.sts import broker
+from cid_dc.writers import open_writer, extension
+from cid_dc.flatten import Flattener
+from cid_dc.checkpoints import read_checkpoint, write_checkpoint
+from cid_dc.throttle import AdaptiveTokenBucket, call_with_backoff
+from cid_dc.upsert_index import read_index, write_index
+
 BUCKET = os.environ['BUCKET_NAME']
 ROLE_NAME = os.environ['ROLE_NAME']
 MODULE_NAME = os.environ['PREFIX']
 TMP_FILE = '/tmp/tmp.json'
 REGION = "us-east-1"
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'json')
+SPLIT_MODE = os.environ.get('SPLIT_MODE', 'none').lower() # none, window or monitor
+WINDOW_DAYS = int(os.environ.get('WINDOW_DAYS', '15'))
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '4'))
+CE_API_RATE = float(os.environ.get('CE_API_RATE', '5'))
+UPSERT_INDEX = os.environ.get('UPSERT_INDEX', 'no').lower() == 'yes'
+COMPACT_DAYS = float(os.environ.get('COMPACT_DAYS', '7'))
+LOOKBACK_DAYS = 90 # cost anomalies are available for the last 90 days
+# an anomaly is written again only if one of these changed since the previous run
+IMPACT_FIELDS = ['AnomalyEndDate', 'MaxImpact', 'TotalActualSpend', 'TotalExpectedSpend', 'TotalImpact', 'TotalImpactpercentage']
 
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
 
+limiter = AdaptiveTokenBucket(CE_API_RATE)
+
 def lambda_handler(event, context): #pylint: disable=unused-argument
     logger.info(f"Incoming event: {json.dumps(event)}")
     key = "account"
@@ -25,122 +45,178 @@ def lambda_handler(event, context): #pylint: disable=unused-argument
 
     account = json.loads(event[key])
     main(account, ROLE_NAME, MODULE_NAME, BUCKET)
+    broker.log_stats()
 
     return {
         'statusCode': 200
     }
 
 def main(account, role_name, module_name, bucket):
-    start_date, end_date = calculate_dates(bucket, s3_path=f'{module_name}/cost-anomaly-data/')
+    account_id = account["account_id"]
+    start_date, end_date = calculate_dates(bucket, module_name, account_id)
     logger.info(f'Using start_date={start_date}, end_date={end_date}')
 
-    data_uploaded = False
-    account_id = account["account_id"]
-    records = get_api_data(role_name, account_id, start_date, end_date)
-    if len(records) > 0:
-        count = process_records(records, TMP_FILE)
-        if count > 0:
-            upload_to_s3(account_id, bucket, module_name, TMP_FILE)
-            data_uploaded = True
-    if not data_uploaded:
+    s3 = boto3.client('s3')
+    index = read_index(s3, bucket, module_name, account_id, IMPACT_FIELDS) if UPSERT_INDEX else None
+    count = process_records(get_api_data(role_name, account_id, start_date, end_date), TMP_FILE, index)
+    if count > 0:
+        upload_to_s3(account_id, bucket, module_name, TMP_FILE)
+        write_checkpoint(s3, bucket, module_name, account_id, start_date, end_date)
+    else:
         logger.info("No file uploaded because no new records were found")
+    if index is not None:
+        compacted_at, records = index.compacted_at, len(index.entries)
+        try:
+            if index.compaction_due(COMPACT_DAYS):
+                write_latest_state(account_id, bucket, module_name, index)
+        except Exception:
+            index.compacted_at = compacted_at # the latest state is written again on the next run
+            raise
+        finally: # the changes written above and the pruned records are kept even if the latest state failed
+            if index.changed > 0 or index.compacted_at != compacted_at or len(index.entries) != records:
+                write_index(s3, bucket, module_name, account_id, index)
 
 def get_api_data(role_name, account_id, start_date, end_date):
-    results = []
+    """ yields the anomalies of the payer between start_date and end_date, once per AnomalyId
+
+    With SPLIT_MODE=window or monitor, the range is fetched as sub-windows of WINDOW_DAYS
+    or per monitor, concurrently, and yielded in window or monitor order
+    """
     client = get_client_with_role(role_name, account_id, region=REGION, service="ce")
+    if SPLIT_MODE == 'window':
+        requests = [{'DateInterval': interval(start, end)} for start, end in split_dates(start_date, end_date, WINDOW_DAYS)]
+    elif SPLIT_MODE == 'monitor':
+        requests = [{'DateInterval': interval(start_date, end_date), 'MonitorArn': arn} for arn in list_monitors(client)]
+    else:
+        requests = [{'DateInterval': interval(start_date, end_date)}]
+
+    seen = set()
+    total = 0
+    for records in fetch_all(client, requests):
+        for record in records:
+            if record['AnomalyId'] in seen:
+                continue
+            seen.add(record['AnomalyId'])
+            total += 1
+            yield record
+    logger.info(f"API results total {total} from {len(requests)} request(s)")
+
+
+def fetch_all(client, requests):
+    """ yields the anomalies of each request, in request order """
+    if len(requests) == 1:
+        yield iterate_anomalies(client, requests[0])
+        return
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(lambda params: list(iterate_anomalies(client, params)), params) for params in requests]
+        for future in futures:
+            yield future.result()
+
+
+def iterate_anomalies(client, params):
+    """ yields the anomalies of each page as it arrives """
     next_token = None
     while True: # operation get_anomalies cannot be paginated
-        params = {
-            "DateInterval": {
-              'StartDate': str(start_date),
-              'EndDate': str(end_date)
-            },
-            "MaxResults": 100,
-        }
+        page_params = {**params, "MaxResults": 100}
         if next_token:
-            params['NextPageToken'] = next_token
-        response = client.get_anomalies(**params)
-        results += response['Anomalies']
-        if 'NextPageToken' in response:
-            next_token = response['NextPageToken']
-        else:
+            page_params['NextPageToken'] = next_token
+        response = call_with_backoff(limiter, client.get_anomalies, **page_params)
+        yield from response['Anomalies']
+        next_token = response.get('NextPageToken')
+        if not next_token:
             break
-    logger.info(f"API results total {len(results)}")
-    return results
 
 
-def process_records(records, tmp_file):
-    count = 0
-    with open(tmp_file, "w", encoding='utf-8') as f:
+def list_monitors(client):
+    """ returns the arns of the anomaly monitors, sorted """
+    arns = []
+    next_token = None
+    while True: # operation get_anomaly_monitors cannot be paginated
+        params = {'NextPageToken': next_token} if next_token else {}
+        response = call_with_backoff(limiter, client.get_anomaly_monitors, **params)
+        arns += [monitor['MonitorArn'] for monitor in response['AnomalyMonitors']]
+        next_token = response.get('NextPageToken')
+        if not next_token:
+            break
+    return sorted(arns)
+
+
+def split_dates(start_date, end_date, days):
+    """ returns consecutive (start, end) windows of `days` covering start_date to end_date """
+    windows = []
+    while True:
+        window_end = min(start_date + timedelta(days=days), end_date)
+        windows.append((start_date, window_end))
+        if window_end >= end_date:
+            return windows
+        start_date = window_end
+
+
+def interval(start_date, end_date):
+    return {'StartDate': str(start_date), 'EndDate': str(end_date)}
+
+
+def process_records(records, tmp_file, index=None):
+    """ writes the flattened records, only the new or changed ones if an upsert index is given """
+    with open_writer(tmp_file, OUTPUT_FORMAT, serializer=to_json) as writer:
         for record in records:
-            data = parse_record(record)
-            f.write(to_json(data) + "\n")
-            count += 1
+            record = parse_record(record)
+            if index is None or index.update(record['AnomalyId'], record):
+                writer.write(record)
+    count = writer.count
     logger.info(f"Processed a total of {count} new records for account")
     return count
 
-def parse_record(record):
-    logger.debug(f"Processing record {record}")
-    result = {
-        'AnomalyId': get_value_by_path(record, 'AnomalyId'),
-        'AnomalyStartDate': get_value_by_path(record, 'AnomalyStartDate'),
-        'AnomalyEndDate': get_value_by_path(record, 'AnomalyEndDate'),
-        'DimensionValue': get_value_by_path(record, 'DimensionValue'),
-        'MaxImpact': get_value_by_path(record, 'Impact/MaxImpact'),
-        'TotalActualSpend': get_value_by_path(record, 'Impact/TotalActualSpend'),
-        'TotalExpectedSpend': get_value_by_path(record, 'Impact/TotalExpectedSpend'),
-        'TotalImpact': get_value_by_path(record, 'Impact/TotalImpact'),
-        'TotalImpactpercentage': float(get_value_by_path(record, 'Impact/TotalImpactPercentage', 0.0)),
-        'MonitorArn': get_value_by_path(record, 'MonitorArn'),
-        'LinkedAccount': get_value_by_path(record, 'RootCauses/0/LinkedAccount'),
-        'LinkedAccountName': get_value_by_path(record, 'RootCauses/0/LinkedAccountName'),
-        'Region': get_value_by_path(record, 'RootCauses/0/Region'),
-        'Service': get_value_by_path(record, 'RootCauses/0/Service'),
-        'UsageType': get_value_by_path(record, 'RootCauses/0/UsageType')
-    }
-    logger.debug("Processing record complete")
-    return result
+parse_record = Flattener({
+    'AnomalyId': 'AnomalyId',
+    'AnomalyStartDate': 'AnomalyStartDate',
+    'AnomalyEndDate': 'AnomalyEndDate',
+    'DimensionValue': 'DimensionValue',
+    'MaxImpact': 'Impact/MaxImpact',
+    'TotalActualSpend': 'Impact/TotalActualSpend',
+    'TotalExpectedSpend': 'Impact/TotalExpectedSpend',
+    'TotalImpact': 'Impact/TotalImpact',
+    'TotalImpactpercentage': {'path': 'Impact/TotalImpactPercentage', 'default': 0.0, 'type': float},
+    'MonitorArn': 'MonitorArn',
+    'LinkedAccount': 'RootCauses/0/LinkedAccount',
+    'LinkedAccountName': 'RootCauses/0/LinkedAccountName',
+    'Region': 'RootCauses/0/Region',
+    'Service': 'RootCauses/0/Service',
+    'UsageType': 'RootCauses/0/UsageType'
+})
 
 
 def upload_to_s3(payer_id, bucket, module_name, tmp_file):
-    key = datetime.now().strftime(f"{module_name}/{module_name}-data/payer_id={payer_id}/year=%Y/month=%m/day=%d/%Y-%m-%d.json")
+    # with the upsert index a file holds only the changes of one run, so runs of the same day must not overwrite each other
+    name = '%Y-%m-%d-%H%M%S' if UPSERT_INDEX else '%Y-%m-%d'
+    key = datetime.now().strftime(f"{module_name}/{module_name}-data/payer_id={payer_id}/year=%Y/month=%m/day=%d/{name}{extension(OUTPUT_FORMAT)}")
     boto3.client('s3').upload_file(tmp_file, bucket, key)
     logger.info(f"Data stored to s3://{bucket}/{key}")
 
 
-def get_value_by_path(data, path, default=None):
-    logger.debug(f"Traversing for path {path}")
-    keys = path.split("/")
-    current = data
-    for key in keys:
-        if isinstance(current, dict) and key in current:
-            current = current.get(key, default)
-        elif isinstance(current, list) and key.isdigit():
-            try:
-                current = current[int(key)]
-            except IndexError:
-                logger.debug(f"Index value {key} within path {path} is not valid in get_value_by_path for data {data}, returning default of {default}")
-                return default
-        else:
-            logger.debug(f"Key value {key} within path {path} is not valid in get_value_by_path for data {data}, returning default of {default}")
-            return default
-    return current
+def write_latest_state(payer_id, bucket, module_name, index):
+    """ replaces the compacted dataset holding the latest version of each anomaly of the payer, without the anomalies
+    that ended before the lookback window. Returns True if the dataset or the index changed
+    """
+    cutoff = (datetime.now().date() - timedelta(days=LOOKBACK_DAYS)).isoformat()
+    dropped = index.compacted(keep=lambda record: not record.get('AnomalyEndDate') or str(record['AnomalyEndDate'])[:10] >= cutoff)
+    key = f"{module_name}/{module_name}-latest/payer_id={payer_id}/latest{extension(OUTPUT_FORMAT)}"
+    with open_writer(TMP_FILE, OUTPUT_FORMAT, serializer=to_json) as writer:
+        for record in index.records():
+            writer.write(record)
+    if writer.count == 0:
+        if dropped:
+            boto3.client('s3').delete_object(Bucket=bucket, Key=key)
+            logger.info(f"All anomalies ended before {cutoff}, removed s3://{bucket}/{key}")
+        return dropped > 0
+    boto3.client('s3').upload_file(TMP_FILE, bucket, key)
+    logger.info(f"Latest state of {writer.count} anomalies stored to s3://{bucket}/{key}")
+    return True
 
 
 def get_client_with_role(role_name, account_id, service, region):
     logger.debug(f"Attempting to get '{service}' client with role '{role_name}' from account '{account_id}' in region '{region}'")
-    credentials = boto3.client('sts').assume_role(
-        RoleArn=f"arn:aws:iam::{account_id}:role/{role_name}",
-        RoleSessionName="data_collection"
-    )['Credentials']
-    logger.debug("Successfully assumed role, now getting client")
-    client = boto3.client(
-        service,
-        region_name = region,
-        aws_access_key_id=credentials['AccessKeyId'],
-        aws_secret_access_key=credentials['SecretAccessKey'],
-        aws_session_token=credentials['SessionToken'],
-    )
+    client = broker.client(account_id, role_name, service, region)
     logger.debug(f"Successfully created '{service}' client with role '{role_name}' from account '{account_id}' in region '{region}'")
     return client
 
@@ -151,20 +227,23 @@ def to_json(obj):
             x.isoformat() if isinstance(x, (date, datetime)) else None
     )
 
-def calculate_dates(bucket, s3_path):
+def calculate_dates(bucket, module_name, payer_id):
+    """ starts from the date of the last upload, read from the checkpoint of the payer
+    or, if there is none, from the objects of the module
+    """
     end_date = datetime.now().date()
-    start_date = datetime.now().date() - timedelta(days=90) #Cost anomalies are available for last 90days
-    # Check the create time of objects in the S3 bucket
-    paginator = boto3.client('s3').get_paginator('list_objects_v2')
-    contents = sum( [page.get('Contents', []) for page in paginator.paginate(Bucket=bucket, Prefix=s3_path)], [])
-    last_modified_date = get_last_modified_date(contents)
+    start_date = datetime.now().date() - timedelta(days=LOOKBACK_DAYS)
+    s3 = boto3.client('s3')
+    checkpoint = read_checkpoint(s3, bucket, module_name, payer_id)
+    if checkpoint:
+        last_modified_date = date.fromisoformat(checkpoint['end'])
+    else:
+        # Check the create time of objects in the S3 bucket, of all payers as before checkpoints existed
+        contents = s3.get_paginator('list_objects_v2').paginate(
+            Bucket=bucket,
+            Prefix=f'{module_name}/cost-anomaly-data/',
+        ).search('Contents')
+        last_modified_date = max([obj['LastModified'].date() for obj in contents if obj], default=None)
     if last_modified_date and last_modified_date >= start_date:
         start_date = last_modified_date
     return start_date, end_date
-
-def get_last_modified_date(contents):
-    last_modified_dates = [obj['LastModified'].date() for obj in contents]
-    last_modified_dates_within_90_days = [date for date in last_modified_dates if date >= datetime.now().date() - timedelta(days=90)]
-    if last_modified_dates_within_90_days:
-        return max(last_modified_dates_within_90_days)
-    return None
@@ -4,10 +4,18 @@ import uuid
 import logging
 import jmespath
 import socket
+from functools import partial
 from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
 
+from cid_dc.sts import broker
+from cid_dc.writers import open_s3_writer, extension
+from cid_dc.throttle import AdaptiveTokenBucket, call_with_backoff
+from cid_dc.flatten import Flattener
+from cid_dc.checkpoints import read_checkpoint, write_checkpoint
+
 logger = logging.getLogger()
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
 
@@ -20,6 +28,13 @@ if len(REGIONS) > 0:
 LOOKBACK = int(os.environ['LOOKBACK'])
 DETAIL_SM_ARN = os.environ['DETAIL_SM_ARN']
 TMP_FILE = "/tmp/data.json"
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'json')
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', '4')) # events pulled concurrently in detail mode
+CHUNK_WORKERS = int(os.environ.get('CHUNK_WORKERS', '8')) # account chunks pulled concurrently, shared by all events
+HEALTH_API_RATE = float(os.environ.get('HEALTH_API_RATE', '10')) # calls per second, lowered on throttling
+
+# shared by all threads, so the rate adapts to throttling of any call
+limiter = AdaptiveTokenBucket(HEALTH_API_RATE)
 
 mapping = {
     'payer_account_id': 'payer_account_id',
@@ -42,12 +57,15 @@ mapping = {
     'start_time': 'event.startTime',
     'end_time': 'event.endTime',
     'last_updated_time': 'event.lastUpdatedTime',
-    'event_metadata': 'eventMetadata',
+    # metadata structure can vary and cause schema change issues, force to string
+    'event_metadata': {'path': 'eventMetadata', 'type': lambda value: value if isinstance(value, str) else json.dumps(value)},
     'event_source': 'event_source',
     'event_arn': 'event.arn',
     'ingestion_time': 'ingestion_time',
 }
 
+flatten = Flattener(mapping)
+
 time_fields_to_convert = ['start_time', 'end_time', 'last_updated_time', 'affected_entity_last_update']
 
 def to_json(obj):
@@ -73,12 +91,18 @@ def int_to_datetime(int_time):
 def iterate_paginated_results(client, function, search, params=None):
     yield from client.get_paginator(function).paginate(**(params or {})).search(search)
 
-def calculate_dates(bucket, s3_path):
-    """ Timeboxes the range of events by seeking the most recent data collection date from the last 90 days """
+def calculate_dates(bucket, s3_path, payer_id):
+    """ Timeboxes the range of events by seeking the most recent data collection date from the last 90 days.
+    The date is read from the checkpoint of the payer or, if there is none, from the objects under s3_path
+    """
     end_date = datetime.now(timezone.utc)
     start_date = end_date - timedelta(days=LOOKBACK)
+    s3 = boto3.client('s3')
+    checkpoint = read_checkpoint(s3, bucket, PREFIX, payer_id)
+    if checkpoint:
+        return max(datetime.fromisoformat(checkpoint['end']), start_date), end_date
     # Check the create time of objects in the S3 bucket
-    contents = boto3.client('s3').get_paginator('list_objects_v2').paginate(
+    contents = s3.get_paginator('list_objects_v2').paginate(
         Bucket=bucket,
         Prefix=s3_path
     ).search('Contents')
@@ -102,51 +126,76 @@ def search(function, args=None, expression='@'):
         else:
             break
 
-def pull_event_details(event, health_client):
+def search_all(request):
+    """ returns the list of results of a (function, args, expression) request """
+    return list(search(*request))
+
+def throttled(function):
+    """ returns the API function called within the shared rate limit, with backoff on throttling """
+    return partial(call_with_backoff, limiter, function)
+
+def pull_event_details(event, health_client, executor=None):
+    """ returns the event merged with its details and affected entities. Account chunks are pulled in the executor if any """
     event_arn = event['arn']
     if event['eventScopeCode'] == 'PUBLIC':
         accounts = [None]
     else:
         accounts = list(search(
-            function=health_client.describe_affected_accounts_for_organization,
+            function=throttled(health_client.describe_affected_accounts_for_organization),
             args={'eventArn': event_arn},
             expression='affectedAccounts',
         ))
 
     # describe_event_details_for_organization only can get 10 per call
-    details = []
-    affected_entities = []
+    details_requests = []
+    entities_requests = []
     for account_chunk in list(chunks(accounts, 10)):
         if account_chunk[0]:
             filters = [{'eventArn':event_arn, 'awsAccountId': account} for account in account_chunk]
         else:
             filters = [{'eventArn':event_arn}]
-        details += list(search(
-            function=health_client.describe_event_details_for_organization,
-            args=dict(
-                organizationEventDetailFilters=filters
-            ),
-            expression='successfulSet',
+        details_requests.append((
+            throttled(health_client.describe_event_details_for_organization),
+            dict(organizationEventDetailFilters=filters),
+            'successfulSet',
         ))
-        affected_entities += list(search(
-            function=health_client.describe_affected_entities_for_organization,
-            args=dict(
-                organizationEntityFilters=filters
-            ),
-            expression='entities',
+        entities_requests.append((
+            throttled(health_client.describe_affected_entities_for_organization),
+            dict(organizationEntityFilters=filters),
+            'entities',
         ))
+    # chunks are pulled concurrently in the executor and joined in chunk order
+    pull = executor.map if executor else map
+    details = pull(search_all, details_requests)
+    affected_entities = pull(search_all, entities_requests)
+    details = [detail for chunk in details for detail in chunk]
+    affected_entities = [entity for chunk in affected_entities for entity in chunk]
+
+    return merge_event_details(event, details, affected_entities)
 
-    # merge with details and affected entities
+def index_details(details):
+    """ returns the details indexed by (account id, event arn), in their original order """
+    index = {}
+    for detail in details:
+        account = detail.get('awsAccountId')
+        event_arn = (detail.get('event') or {}).get('arn')
+        if isinstance(account, str) and isinstance(event_arn, str):
+            index.setdefault((account, event_arn), []).append(detail)
+    return index
+
+def merge_event_details(event, details, affected_entities):
+    """ returns one record per affected entity, merged with the event and the details of its account """
     event_details_per_affected = []
     if len(affected_entities) == 0:
         event = {**event, **details[0]}
         event_details_per_affected.append(event)
+    index = index_details(details)
     for affected_entity in affected_entities:
         account = affected_entity['awsAccountId']
         event_arn = affected_entity['eventArn']
         affected_entity['entityStatusCode'] = affected_entity.pop('statusCode', None)
         affected_entity['entityLastUpdatedTime'] = affected_entity.pop('lastUpdatedTime', None)
-        detail = jmespath.search(f"[?awsAccountId=='{account}']|[?event.arn=='{event_arn}']", details)
+        detail = index.get((str(account), str(event_arn)), [])
         for detail_rec in detail:
             metadata = detail_rec.get('eventMetadata') or {}
             deprecated_versions = metadata.pop('deprecated_versions', None)
@@ -198,21 +247,11 @@ def lambda_handler(event, context): #pylint: disable=unused-argument
     account = json.loads(account) if is_summary_mode else batch_input.get('account')
     account_id = account["account_id"]
 
-    creds = boto3.client('sts').assume_role(
-        RoleArn=f"arn:aws:iam::{account_id}:role/{ROLENAME}",
-        RoleSessionName="data_collection"
-    )['Credentials']
-    health_client = boto3.client(
-        'health',
-        region_name=get_active_health_region(),
-        aws_access_key_id=creds['AccessKeyId'],
-        aws_secret_access_key=creds['SecretAccessKey'],
-        aws_session_token=creds['SessionToken'],
-    )
+    health_client = broker.client(account_id, ROLENAME, 'health', get_active_health_region())
 
     count = 0
     if is_summary_mode:
-        start_from, start_to = calculate_dates(BUCKET_NAME, f"{PREFIX}/{PREFIX}-summary-data/payer_id={account_id}")
+        start_from, start_to = calculate_dates(BUCKET_NAME, f"{PREFIX}/{PREFIX}-summary-data/payer_id={account_id}", account_id)
         logger.info(f"Collecting events from {start_from} to {start_to}")
         args = {
             'maxResults':100,
@@ -229,13 +268,14 @@ def lambda_handler(event, context): #pylint: disable=unused-argument
         try:
             with open(TMP_FILE, "w", encoding='utf-8') as f:
                 f.write('eventArn,eventScopeCode\n')
-                for _, h_event in enumerate(search(health_client.describe_events_for_organization, args, expression='events')):
+                for _, h_event in enumerate(search(throttled(health_client.describe_events_for_organization), args, expression='events')):
                     f.write(f'{h_event["arn"]},{h_event["eventScopeCode"]}\n')
                     count += 1
             if count > 0:
                 key = ingestion_time.strftime(f"{PREFIX}/{PREFIX}-summary-data/payer_id={account_id}/year=%Y/month=%m/day=%d/%Y-%m-%d.csv")
                 boto3.client('s3').upload_file(TMP_FILE, BUCKET_NAME, key)
                 logger.info(f'Uploaded {count} summary records to s3://{BUCKET_NAME}/{key}')
+                write_checkpoint(boto3.client('s3'), BUCKET_NAME, PREFIX, account_id, start_from, start_to)
                 # clear any previous runs for the same day
                 bucket = boto3.resource('s3').Bucket(BUCKET_NAME)
                 bucket.objects.filter(Prefix=ingestion_time.strftime(f"{PREFIX}/{PREFIX}-detail-data/payer_id={account_id}/year=%Y/month=%m/day=%d")).delete()
@@ -258,26 +298,27 @@ def lambda_handler(event, context): #pylint: disable=unused-argument
 
     elif items:
         ingestion_time = datetime.fromtimestamp(int(batch_input.get('ingestion_time')))
+        rand = uuid.uuid4()
+        key = ingestion_time.strftime(f"{PREFIX}/{PREFIX}-detail-data/payer_id={account_id}/year=%Y/month=%m/day=%d/%Y-%m-%d-%H-%M-%S-{rand}{extension(OUTPUT_FORMAT)}")
 
-        with open(TMP_FILE, "w", encoding='utf-8') as f:
+        # events are pulled concurrently and their records are streamed to s3 as each event completes
+        with open_s3_writer(BUCKET_NAME, key, OUTPUT_FORMAT, serializer=to_json) as writer, \
+                ThreadPoolExecutor(max_workers=CHUNK_WORKERS) as chunk_executor, \
+                ThreadPoolExecutor(max_workers=EVENT_WORKERS) as event_executor:
+            futures = []
             for item in items:
                 h_event = {'arn': item['eventArn'], 'eventScopeCode': item['eventScopeCode']}
                 h_event['payer_account_id'] = account_id
                 h_event['event_source'] = "aws.health"
                 h_event['ingestion_time'] = ingestion_time
-                all_detailed_events = pull_event_details(h_event, health_client)
-                flatten_events = jmespath.search("[].{"+', '.join([f'{k}: {v}' for k, v in mapping.items()]) + "}", all_detailed_events)
-                for flatten_event in flatten_events:
+                futures.append(event_executor.submit(pull_event_details, h_event, health_client, chunk_executor))
+            for future in as_completed(futures):
+                all_detailed_events = future.result()
+                for flatten_event in flatten.flatten_all(all_detailed_events):
                     flatten_event = event_item_to_date(flatten_event, time_fields_to_convert)
-                    # metadata structure can vary and cause schema change issues, force to string
-                    metadata = flatten_event.get('event_metadata')
-                    metadata = json.dumps(metadata) if (not isinstance(metadata, str)) and (metadata != None) else metadata
-                    flatten_event['event_metadata'] = metadata
-                    f.write(to_json(flatten_event) + '\n')
-                    count += 1
+                    writer.write(flatten_event)
+        count = writer.count
         if count > 0:
-            rand = uuid.uuid4()
-            key = ingestion_time.strftime(f"{PREFIX}/{PREFIX}-detail-data/payer_id={account_id}/year=%Y/month=%m/day=%d/%Y-%m-%d-%H-%M-%S-{rand}.json")
-            boto3.client('s3').upload_file(TMP_FILE, BUCKET_NAME, key)
             logger.info(f'Uploaded {count} summary records to s3://{BUCKET_NAME}/{key}')
+    broker.log_stats()
     return {"status":"200","Recorded":f'"{count}"'}
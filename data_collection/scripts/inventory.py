@@ -1,22 +1,54 @@
 """ Scan linked accounts and store instances info to s3 bucket
 Supported types: ebs, snapshots, ami, rds instances
+Several types can be collected in one invocation, sharing the assumed session
+
+With DELTA_MODE=yes, a manifest of resource ids and content hashes is kept per
+account and sub module. A full baseline (change_type=baseline) is written every
+BASELINE_PERIOD_DAYS, and in between only added, changed and removed records.
 """
 import os
+import gzip
 import json
+import hashlib
 import logging
-from functools import partial, lru_cache
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timezone
 
 import boto3
 from botocore.client import Config
+from botocore.exceptions import ClientError
+
+from cid_dc.sts import broker
+from cid_dc.writers import open_s3_writer, extension
 
-TMP_FILE = "/tmp/data.json"
 PREFIX = os.environ['PREFIX']
 BUCKET = os.environ["BUCKET_NAME"]
 ROLENAME = os.environ['ROLENAME']
 REGIONS = [r.strip() for r in os.environ["REGIONS"].split(',') if r]
 TRACKING_TAGS = os.environ.get("TRACKING_TAGS")
 TAG_LIST = TRACKING_TAGS.split(",") if TRACKING_TAGS else []
+MAX_REGION_WORKERS = int(os.environ.get('MAX_REGION_WORKERS', '8'))
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '32'))
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'json')
+DELTA_MODE = os.environ.get('DELTA_MODE', 'no').lower() == 'yes'
+BASELINE_PERIOD_DAYS = int(os.environ.get('BASELINE_PERIOD_DAYS', '49')) # 4 runs of the 14 days schedule, minus a margin
+
+# field identifying a resource of each sub module, used by the delta mode
+RESOURCE_ID_FIELDS = {
+    'opensearch-domains': 'DomainId',
+    'elasticache-clusters': 'ARN',
+    'rds-db-clusters': 'DBClusterArn',
+    'rds-db-instances': 'DBInstanceArn',
+    'rds-db-snapshots': 'DBSnapshotArn',
+    'ebs': 'VolumeId',
+    'ami': 'ImageId',
+    'snapshot': 'SnapshotId',
+    'ec2-instances': 'InstanceId',
+    'vpc': 'VpcId',
+    'lambda-functions': 'FunctionArn',
+    'eks': 'Arn',
+}
 
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
@@ -29,88 +61,63 @@ def to_json(obj):
             x.isoformat() if isinstance(x, (date, datetime)) else None
     )
 
-@lru_cache(maxsize=10000)
-def assume_session(account_id, region):
-    """assume role in account"""
-    credentials = boto3.client('sts', region_name=region).assume_role(
-        RoleArn=f"arn:aws:iam::{account_id}:role/{ROLENAME}" ,
-        RoleSessionName="data_collection"
-    )['Credentials']
-    return boto3.session.Session(
-        aws_access_key_id=credentials['AccessKeyId'],
-        aws_secret_access_key=credentials['SecretAccessKey'],
-        aws_session_token=credentials['SessionToken']
-    )
-
 def paginated_scan(service, account_id, function_name, region, params=None, obj_name=None):
     """ paginated scan """
     obj_name = obj_name or function_name.split('_')[-1].capitalize() + '[*]'
-    session = assume_session(account_id, region)
-    client = session.client(service, region_name=region)
-    try:
-        yield from client.get_paginator(function_name).paginate(**(params or {})).search(obj_name)
-    except Exception as exc:  #pylint: disable=broad-exception-caught
-        logger.info(f'Error in scan {function_name}/{account_id}: {exc}')
+    client = broker.client(account_id, ROLENAME, service, region)
+    yield from client.get_paginator(function_name).paginate(**(params or {})).search(obj_name)
 
 def opensearch_domains_scan(account_id, region):
     """ special treatment for opensearch_scan """
     service = 'opensearch'
-    session = assume_session(account_id, region)
-    client = session.client(service, region_name=region)
-    try:
-        domain_names = [name.get('DomainName') for name in client.list_domain_names().get('DomainNames', [])]
-        for domain_name in domain_names:
-            domain = client.describe_domain(DomainName=domain_name)['DomainStatus']
-            yield {
-                'DomainName': domain['DomainName'],
-                'DomainId': domain['DomainId'],
-                'EngineVersion': domain['EngineVersion'],
-                'InstanceType': domain['ClusterConfig']['InstanceType'],
-                'InstanceCount': domain['ClusterConfig']['InstanceCount'],
-            }
-    except Exception as exc:  #pylint: disable=broad-exception-caught
-        logger.info(f'scan {service}/{account_id}/{region}: {exc}')
+    client = broker.client(account_id, ROLENAME, service, region)
+    domain_names = [name.get('DomainName') for name in client.list_domain_names().get('DomainNames', [])]
+    for domain_name in domain_names:
+        domain = client.describe_domain(DomainName=domain_name)['DomainStatus']
+        yield {
+            'DomainName': domain['DomainName'],
+            'DomainId': domain['DomainId'],
+            'EngineVersion': domain['EngineVersion'],
+            'InstanceType': domain['ClusterConfig']['InstanceType'],
+            'InstanceCount': domain['ClusterConfig']['InstanceCount'],
+        }
 
 def eks_clusters_scan(account_id, region):
     """special function to scan EKS clusters"""
     service = "eks"
-    session = assume_session(account_id, region)
-    client = session.client(service, region_name=region)
-    try:
-        for cluster_name in (
-            client.get_paginator("list_clusters")
-            .paginate(
-                PaginationConfig={
-                    "PageSize": 100,
-                }
-            )
-            .search("clusters")
-        ):
-            cluster = client.describe_cluster(name=cluster_name)
-            yield {
-                "Arn": cluster["cluster"]["arn"],
-                "Name": cluster["cluster"]["name"],
-                "CreatedAt": datetime.strftime(
-                    cluster["cluster"]["createdAt"].astimezone(tz=timezone.utc), "%Y-%m-%dT%H:%M:%SZ"
-                ),
-                "Version": cluster["cluster"]["version"],
+    client = broker.client(account_id, ROLENAME, service, region)
+    for cluster_name in (
+        client.get_paginator("list_clusters")
+        .paginate(
+            PaginationConfig={
+                "PageSize": 100,
             }
-    except Exception as exc: #pylint: disable=W0718
-        logger.error(f"Cannot get info from {account_id}/{region}: {type(exc)}-{exc}")
-    return []
+        )
+        .search("clusters")
+    ):
+        cluster = client.describe_cluster(name=cluster_name)
+        yield {
+            "Arn": cluster["cluster"]["arn"],
+            "Name": cluster["cluster"]["name"],
+            "CreatedAt": datetime.strftime(
+                cluster["cluster"]["createdAt"].astimezone(tz=timezone.utc), "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            "Version": cluster["cluster"]["version"],
+        }
 
 def lambda_handler(event, context): #pylint: disable=unused-argument
     """ this lambda collects ami, snapshots and volumes from linked accounts
-    and must be called from the corresponding Step Function to orchestrate
+    and must be called from the corresponding Step Function to orchestrate.
+    Several sub modules can be collected in one invocation: either a list in
+    'sub_modules' or space separated names in 'params'
     """
     logger.info(f"Event data: {event}")
-    if 'account' not in event or 'params' not in event  :
+    if 'account' not in event or ('params' not in event and 'sub_modules' not in event):
         raise ValueError(
             "Please do not trigger this Lambda manually."
             "Find the corresponding state machine in Step Functions and Trigger from there."
         )
-    params = [p for p in event.get('params', '').split() if p]
-    name = params[0]
+    names = event.get('sub_modules') or [p for p in event.get('params', '').split() if p]
 
     sub_modules = {
         'opensearch-domains': opensearch_domains_scan, # special function for opensearch
@@ -179,43 +186,160 @@ def lambda_handler(event, context): #pylint: disable=unused-argument
     account = json.loads(event["account"])
     account_id = account["account_id"]
     payer_id = account["payer_id"]
-    func = sub_modules[name]
-    counter = 0
-    logger.info(f"Collecting {name} for account {account_id}")
+    unknown = [name for name in names if name not in sub_modules]
+    if unknown:
+        logger.error(f"Unknown sub modules {unknown}. Supported: {list(sub_modules)}")
+        names = [name for name in names if name in sub_modules]
+    logger.info(f"Collecting {names} for account {account_id}")
     collection_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # All (sub module, region) scans share one pool and the cached session and clients of the account.
+    # Each region scans into its own buffer and buffers are merged in REGIONS order.
+    max_workers = min(MAX_REGION_WORKERS * len(names), MAX_WORKERS, len(names) * len(REGIONS))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        scans = {
+            name: [
+                executor.submit(scan_region, sub_modules[name], name, account_id, region, collection_date)
+                for region in REGIONS
+            ]
+            for name in names
+        }
+        for name, futures in scans.items():
+            try:
+                # records are streamed to s3 as soon as the regions complete, in REGIONS order
+                results = (future.result() for future in futures)
+                if DELTA_MODE:
+                    manifest = Manifest(name, account_id, payer_id)
+                    counter = upload_to_s3(name, account_id, payer_id, manifest.diff(results, collection_date))
+                    manifest.save()
+                else:
+                    counter = upload_to_s3(name, account_id, payer_id, (record for _, records, _ in results for record in records))
+                logger.info(f"Collected {counter} total {name} instances")
+            except Exception as exc:   #pylint: disable=broad-exception-caught
+                logger.info(f"{name}: {type(exc)} - {exc}" )
+    broker.log_stats()
+
+def scan_region(func, name, account_id, region, collection_date):
+    """scan one region and return a tuple (region, records, failed).
+    Errors are logged and do not affect other regions"""
+    logger.info(f"Collecting in {region}")
+    records = []
+    failed = False
     try:
-        with open(TMP_FILE, "w", encoding='utf-8') as file_:
-            for region in REGIONS:
-                logger.info(f"Collecting in {region}")
-                for counter, obj in enumerate(func(account_id=account_id,region=region), start=counter + 1):
-                    obj['accountid'] = account_id
-                    if len(TAG_LIST) > 0 and "Tags" in obj:
-                        logger.debug(f"Tags enabled and found tags {obj['Tags']}")
-                        for tag in obj["Tags"]:
-                            if tag["Key"] in TAG_LIST:
-                                obj[f"tag_{tag['Key']}"] = tag["Value"]
-                    obj['collection_date'] = collection_date
-                    obj['region'] = region
-                    if 'Environment' in obj and name == 'lambda-functions':
-                        obj['Environment'] = to_json(obj['Environment']) # this property breaks crawler as it has a different key structure
-                    file_.write(to_json(obj) + "\n")
-        logger.info(f"Collected {counter} total {name} instances")
-        upload_to_s3(name, account_id, payer_id)
+        for obj in func(account_id=account_id, region=region):
+            records.append(format_record(obj, name, account_id, region, collection_date))
     except Exception as exc:   #pylint: disable=broad-exception-caught
-        logger.info(f"{name}: {type(exc)} - {exc}" )
+        logger.error(f"Error in scan {name}/{account_id}/{region}: {type(exc)} - {exc}")
+        failed = True
+    logger.debug(f"Collected {len(records)} {name} instances in {region}")
+    return region, records, failed
 
-def upload_to_s3(name, account_id, payer_id):
-    """upload"""
-    if os.path.getsize(TMP_FILE) == 0:
-        logger.info(f"No data in file for {name}")
-        return
+def format_record(obj, name, account_id, region, collection_date):
+    """add account, tags and collection info to the record"""
+    obj['accountid'] = account_id
+    if len(TAG_LIST) > 0 and "Tags" in obj:
+        logger.debug(f"Tags enabled and found tags {obj['Tags']}")
+        for tag in obj["Tags"]:
+            if tag["Key"] in TAG_LIST:
+                obj[f"tag_{tag['Key']}"] = tag["Value"]
+    obj['collection_date'] = collection_date
+    obj['region'] = region
+    if 'Environment' in obj and name == 'lambda-functions':
+        obj['Environment'] = to_json(obj['Environment']) # this property breaks crawler as it has a different key structure
+    return obj
+
+class Manifest():
+    """ resource ids and content hashes of the last collection of a sub module in an account.
+    Stored in s3 outside of the crawled data prefix.
+    """
+    def __init__(self, name, account_id, payer_id):
+        self.name = name
+        self.account_id = account_id
+        self.id_field = RESOURCE_ID_FIELDS[name]
+        self.key = f"{PREFIX}/{PREFIX}-manifests/{name}/payer_id={payer_id}/{account_id}.json.gz"
+        self.s3 = boto3.client("s3")
+        self.baseline_date = None
+        self.hashes = {}
+        self.new_hashes = {}
+        self.new_baseline_date = None
+        try:
+            manifest = json.loads(gzip.decompress(self.s3.get_object(Bucket=BUCKET, Key=self.key)['Body'].read()))
+            self.baseline_date = date.fromisoformat(manifest['baseline_date'])
+            self.hashes = manifest['resources']
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            logger.info(f"No manifest for {name}. A baseline will be written")
+
+    def is_baseline_due(self):
+        """ True if a full collection must be written """
+        return self.baseline_date is None or (date.today() - self.baseline_date).days >= BASELINE_PERIOD_DAYS
+
+    @staticmethod
+    def content_hash(record):
+        """ hash of the record without collection info """
+        content = {k: v for k, v in record.items() if k != 'collection_date'}
+        return hashlib.sha1(to_json(dict(sorted(content.items()))).encode('utf-8')).hexdigest()
+
+    def diff(self, results, collection_date):
+        """ yields all records for a baseline, else the added, changed and removed ones.
+        results are (region, records, failed) tuples from scan_region. Resources of failed
+        regions are kept in the manifest and never reported as removed.
+        """
+        baseline = self.is_baseline_due()
+        self.new_baseline_date = date.today() if baseline else self.baseline_date
+        failed_regions = set()
+        for region, records, failed in results:
+            if failed:
+                failed_regions.add(region)
+            for record in records:
+                resource_key = f"{region}|{record.get(self.id_field)}"
+                content_hash = self.content_hash(record)
+                self.new_hashes[resource_key] = content_hash
+                if baseline:
+                    record['change_type'] = 'baseline'
+                elif resource_key not in self.hashes:
+                    record['change_type'] = 'added'
+                elif self.hashes[resource_key] != content_hash:
+                    record['change_type'] = 'changed'
+                else:
+                    continue
+                yield record
+        for resource_key, content_hash in self.hashes.items():
+            if resource_key in self.new_hashes:
+                continue
+            region, resource_id = resource_key.split('|', 1)
+            if region in failed_regions:
+                self.new_hashes[resource_key] = content_hash
+            elif not baseline:
+                yield {
+                    self.id_field: resource_id,
+                    'accountid': self.account_id,
+                    'collection_date': collection_date,
+                    'region': region,
+                    'change_type': 'removed',
+                }
+
+    def save(self):
+        """ store the manifest of the current collection. Call after a successful upload """
+        manifest = {'baseline_date': self.new_baseline_date.isoformat(), 'resources': self.new_hashes}
+        self.s3.put_object(Bucket=BUCKET, Key=self.key, Body=gzip.compress(json.dumps(manifest).encode('utf-8')))
+        logger.info(f"Manifest with {len(self.new_hashes)} {self.name} resources stored in s3://{BUCKET}/{self.key}")
+
+def upload_to_s3(name, account_id, payer_id, records):
+    """stream records to s3 and return their number"""
+    # in delta mode a file holds only the changes of one run, so runs of the same day must not overwrite each other
+    name_format = '%Y-%m-%d-%H%M%S' if DELTA_MODE else '%Y-%m-%d'
     key =  datetime.now().strftime(
         f"{PREFIX}/{PREFIX}-{name}-data/payer_id={payer_id}"
-        f"/year=%Y/month=%m/day=%d/{account_id}-%Y-%m-%d.json"
+        f"/year=%Y/month=%m/day=%d/{account_id}-{name_format}{extension(OUTPUT_FORMAT)}"
     )
     s3client = boto3.client("s3", config=Config(s3={"addressing_style": "path"}))
-    try:
-        s3client.upload_file(TMP_FILE, BUCKET, key)
+    with open_s3_writer(BUCKET, key, OUTPUT_FORMAT, serializer=to_json, s3_client=s3client) as writer:
+        for record in records:
+            writer.write(record)
+    if writer.count == 0:
+        logger.info(f"No data in file for {name}")
+    else:
         logger.info(f"Data {account_id} in s3 - {BUCKET}/{key}")
-    except Exception as exc:  #pylint: disable=broad-exception-caught
-        logger.info(exc)
+    return writer.count
@@ -5,16 +5,25 @@ import re
 import json
 import logging
 import datetime
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.exceptions import ClientError
 from botocore.client import Config
 
+from cid_dc.sts import broker
+from cid_dc.throttle import TokenBucket, call_with_backoff
+from cid_dc.org_snapshot import write_snapshot
+from cid_dc.writers import open_writer, extension
+
 BUCKET = os.environ['BUCKET_NAME']
 ROLE = os.environ['ROLENAME']
 PREFIX = os.environ['PREFIX']
 REGIONS = ["us-east-1"] #This MUST be us-east-1 regardless of region of Lambda
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'json')
+OU_TREE_PREFETCH = os.environ.get('OU_TREE_PREFETCH', 'yes').lower() == 'yes' # resolve parents from one walk of the OU tree
+ORG_API_RATE = float(os.environ.get('ORG_API_RATE', '8')) # calls per second, below the Organizations API quota
+TAG_WORKERS = int(os.environ.get('TAG_WORKERS', '8'))
 
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
@@ -28,37 +37,32 @@ def lambda_handler(event, context):
         )
     account = json.loads(event["account"])
     try:
-        process_management_acc(account["account_id"])
+        process_management_acc(account["account_id"], account.get("payer_id", account["account_id"]))
     except Exception as exc:
         logger.warning(exc)
+    broker.log_stats()
 
-def process_management_acc(management_account_id):
+def process_management_acc(management_account_id, payer_id=None):
     """Get info from management account and write to s3"""
     logger.info(f'Assuming role {ROLE} in {management_account_id}')
-    cred = boto3.client('sts', region_name=REGIONS[0]).assume_role(
-        RoleArn=f"arn:aws:iam::{management_account_id}:role/{ROLE}",
-        RoleSessionName="data_collection"
-    )['Credentials']
-    client = boto3.client(
-        "organizations",
-        region_name=REGIONS[0],
-        aws_access_key_id=cred['AccessKeyId'],
-        aws_secret_access_key=cred['SecretAccessKey'],
-        aws_session_token=cred['SessionToken'],
-    )
-    accounts = list(OrgController(client).iterate_accounts())
+    client = broker.client(management_account_id, ROLE, "organizations", REGIONS[0])
+    controller = OrgController(client)
+    if OU_TREE_PREFETCH:
+        controller.prefetch_tree()
+    accounts = list(controller.iterate_accounts())
     logger.debug(f'Uploading {len(accounts)} records')
     s3_upload(management_account_id, accounts)
+    write_snapshot(boto3.client('s3'), BUCKET, payer_id or management_account_id, accounts) # reused by the account collector
 
 
 def s3_upload(payer_id, data):
     """Upload records to s3"""
     tmp_file = f'/tmp/accounts-{payer_id}.json'
-    with open(tmp_file, 'w', encoding='utf-8') as file_:
+    with open_writer(tmp_file, OUTPUT_FORMAT, serializer=lambda line: json.dumps(line, default=json_converter)) as writer:
         for line in data:
-            file_.write(json.dumps(line, default=json_converter) + '\n')
+            writer.write(line)
     try:
-        prefix = f"{PREFIX}/organization-data/payer_id={payer_id}/acc-org.json" # No time/date info. Each time we override data
+        prefix = f"{PREFIX}/organization-data/payer_id={payer_id}/acc-org{extension(OUTPUT_FORMAT)}" # No time/date info. Each time we override data
         boto3.client('s3').upload_file(tmp_file, BUCKET, prefix)
         logger.info(f"Uploaded {len(data)} records in s3://{BUCKET}/{prefix}")
     except Exception as exc:
@@ -74,21 +78,67 @@ class OrgController():
     """ AWS Organizations controller """
     def __init__(self, client):
         self.org = client
+        self.limiter = TokenBucket(ORG_API_RATE)
+        self.parents = {} # child id -> parent, filled by prefetch_tree
+        self.ou_names = {}
+        self.ou_paths = {}
+        self.tags = {}
+        self.inherited_tags = {} # OU or root id -> tags of the OU merged with the ones of its ancestors
+
+    def call(self, method, **kwargs):
+        """ rate limited call of the Organizations API, retried with backoff when throttled """
+        return call_with_backoff(self.limiter, getattr(self.org, method), **kwargs)
+
+    def pages(self, method, key, **kwargs):
+        """ yields the items `key` of all pages of a list method, each page being a rate limited call """
+        while True:
+            resp = self.call(method, **kwargs)
+            yield from resp[key]
+            if not resp.get('NextToken'):
+                return
+            kwargs['NextToken'] = resp['NextToken']
+
+    def prefetch_tree(self):
+        """walks the OU tree top-down once, so parents and OU names of all accounts are resolved
+        from memory instead of list_parents and describe_organizational_unit calls per account
+        """
+        pending = [{'Id': root['Id'], 'Type': 'ROOT'} for root in self.pages('list_roots', 'Roots')]
+        while pending:
+            parent = pending.pop()
+            for ou in self.pages('list_organizational_units_for_parent', 'OrganizationalUnits', ParentId=parent['Id']):
+                self.parents[ou['Id']] = parent
+                self.ou_names[ou['Id']] = ou['Name']
+                pending.append({'Id': ou['Id'], 'Type': 'ORGANIZATIONAL_UNIT'})
+            for account in self.pages('list_accounts_for_parent', 'Accounts', ParentId=parent['Id']):
+                self.parents[account['Id']] = parent
+        logger.info(f'Prefetched OU tree: {len(self.ou_names)} OUs, {len(self.parents) - len(self.ou_names)} accounts')
+
+    def prefetch_tags(self, ids):
+        """fetches the tags of accounts, OUs and roots concurrently, within ORG_API_RATE"""
+        ids = [id_ for id_ in dict.fromkeys(ids) if id_ not in self.tags]
+        with ThreadPoolExecutor(max_workers=TAG_WORKERS) as executor:
+            for id_, tags in zip(ids, executor.map(self.get_tags, ids)):
+                self.tags[id_] = tags
+        logger.info(f'Prefetched tags of {len(ids)} resources')
 
-    @lru_cache(maxsize=10000)
     def get_ou_name(self, id_):
         """get ou name"""
-        resp = self.org.describe_organizational_unit(OrganizationalUnitId=id_)
-        return resp['OrganizationalUnit']['Name']
+        if id_ not in self.ou_names:
+            resp = self.call('describe_organizational_unit', OrganizationalUnitId=id_)
+            self.ou_names[id_] = resp['OrganizationalUnit']['Name']
+        return self.ou_names[id_]
 
-    @lru_cache(maxsize=10000)
     def get_parent(self, id_):
         """list parents of account or ou"""
-        return self.org.list_parents(ChildId=id_)['Parents'][0]
+        if id_ not in self.parents:
+            # not in the prefetched tree (ex: moved during the walk)
+            self.parents[id_] = self.call('list_parents', ChildId=id_)['Parents'][0]
+        return self.parents[id_]
 
-    @lru_cache(maxsize=10000)
     def get_ou_path(self, id_):
         """returns a list of OUs up to Root level"""
+        if id_ in self.ou_paths:
+            return self.ou_paths[id_]
         path = []
         current = {'Id': id_}
         while current.get('Type') != 'ROOT':
@@ -101,41 +151,46 @@ class OrgController():
                 tags = self.get_tags(current["Id"])
                 current['Name'] = tags.get('Name', f'ROOT({current["Id"]})')
             path.append(current)
-        return path[::-1]
+        self.ou_paths[id_] = path[::-1]
+        return self.ou_paths[id_]
 
-    @lru_cache(maxsize=10000)
     def get_tags(self, id_, athena_friendly=False):
         """returns a dict of tags"""
-        paginator = self.org.get_paginator("list_tags_for_resource")
-        tags = sum([resp['Tags'] for resp in paginator.paginate(ResourceId=id_)], [])
-        return {tag['Key']: tag['Value'] for tag in tags}
+        if id_ in self.tags:
+            return self.tags[id_]
+        self.tags[id_] = {tag['Key']: tag['Value'] for tag in self.pages('list_tags_for_resource', 'Tags', ResourceId=id_)}
+        return self.tags[id_]
 
-    @lru_cache(maxsize=10000)
     def get_hierarchy_tags(self, id_):
         """returns a dict of tags, updated according AWS Org hierarchy"""
         tags = {}
-        full_path = self.get_ou_path(id_) + [{'Id': id_}]
-        for level in full_path:
-            tags.update(self.get_tags(level['Id'], athena_friendly=True))
-        return tags
+        for level in self.get_ou_path(id_): # inherited tags are merged once per OU, top-down
+            if level['Id'] not in self.inherited_tags:
+                self.inherited_tags[level['Id']] = {**tags, **self.get_tags(level['Id'], athena_friendly=True)}
+            tags = self.inherited_tags[level['Id']]
+        return {**tags, **self.get_tags(id_, athena_friendly=True)}
 
     def iterate_accounts(self):
         """iterate over accounts"""
-        for page in self.org.get_paginator('list_accounts').paginate():
-            for account in page['Accounts']:
-                logger.info('processing %s', account['Id'])
-                account['Hierarchy'] = self.get_ou_path(account['Id'])
-                account['HierarchyPath'] = ' > '.join([
-                    lvl.get('Name', lvl.get('Id')) for lvl in account['Hierarchy']
-                ])
-                account['HierarchyTags'] = [ {'Key': key, 'Value': value} for key, value in self.get_hierarchy_tags(account['Id']).items()]
-                account['ManagementAccountId'] =  account['Arn'].split(':')[4]
-                account['Parent'] = account['Hierarchy'][-1].get('Name')
-                account['ParentId'] = account['Hierarchy'][-1].get('Id')
-                account['ParentTags'] = [ {'Key': key, 'Value': value} for key, value in self.get_tags(account['ParentId']).items()]
-                #account['Parent_Tags'] = self.get_tags(account['ParentId']) # Uncomment for Backward Compatibility
-                logger.debug(json.dumps(account, indent=2, default=json_converter))
-                yield account
+        accounts = [account for page in self.org.get_paginator('list_accounts').paginate() for account in page['Accounts']]
+        self.prefetch_tags(
+            [account['Id'] for account in accounts]
+            + [level['Id'] for account in accounts for level in self.get_ou_path(account['Id'])]
+        )
+        for account in accounts:
+            logger.info('processing %s', account['Id'])
+            account['Hierarchy'] = self.get_ou_path(account['Id'])
+            account['HierarchyPath'] = ' > '.join([
+                lvl.get('Name', lvl.get('Id')) for lvl in account['Hierarchy']
+            ])
+            account['HierarchyTags'] = [ {'Key': key, 'Value': value} for key, value in self.get_hierarchy_tags(account['Id']).items()]
+            account['ManagementAccountId'] =  account['Arn'].split(':')[4]
+            account['Parent'] = account['Hierarchy'][-1].get('Name')
+            account['ParentId'] = account['Hierarchy'][-1].get('Id')
+            account['ParentTags'] = [ {'Key': key, 'Value': value} for key, value in self.get_tags(account['ParentId']).items()]
+            #account['Parent_Tags'] = self.get_tags(account['ParentId']) # Uncomment for Backward Compatibility
+            logger.debug(json.dumps(account, indent=2, default=json_converter))
+            yield account
 
 def test():
     """ local test """
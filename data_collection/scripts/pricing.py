@@ -1,9 +1,19 @@
+import io
 import os
+import csv
 import json
+import time
+import queue
+import hashlib
 import urllib3
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.exceptions import ClientError
+
+from cid_dc.writers import open_s3_writer, extension
 
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
@@ -16,14 +26,254 @@ PREFIX = os.environ["DEST_PREFIX"]
 REGIONS = [r.strip() for r in os.environ["REGIONS"].split(',') if r]
 TMP_FILE = "/tmp/data.json"
 RDS_GRAVITON_PATH = os.environ["RDS_GRAVITON_PATH"]
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '4'))
+OFFERS_CACHE_FILE = "/tmp/offers-index.json"
+OFFERS_CACHE_KEY = "pricing/pricing-cache/offers-index.json"
+OFFERS_CACHE_TTL = int(os.environ.get('OFFERS_CACHE_TTL', '3600')) # seconds
+OFFERS_CACHE_S3 = os.environ.get('OFFERS_CACHE_S3', 'no').lower() == 'yes'
+# Optional streaming transform per service path. Ex:
+# {"ec2": {"columns": ["SKU", "PricePerUnit", ...], "filters": {"Product Family": ["Compute Instance"]},
+#          "format": "parquet", "types": {"priceperunit": "double"}}}
+# Regions of the other paths are copied as is.
+TRANSFORMS = json.loads(os.environ.get('PRICING_TRANSFORMS') or '{}')
+PREFETCH_CHUNKS = int(os.environ.get('PREFETCH_CHUNKS', '16')) # chunks of 1MB downloaded ahead of the transform
+OUTPUT_FORMATS = ['csv', 'csv.gz', 'parquet']
+
+# pooled connections reused by all requests and across warm invocations
+HTTP = urllib3.PoolManager(maxsize=max(MAX_WORKERS, 10))
 
 def get_json(url):
-    return json.loads(urllib3.PoolManager().request('GET', url).data)
+    return json.loads(HTTP.request('GET', url).data)
+
+def is_fresh(cache):
+    return time.time() - cache['fetched_at'] < OFFERS_CACHE_TTL
+
+def read_offers_cache(s3):
+    """ returns the most recent cached offers index from /tmp or, if enabled, from s3 """
+    caches = []
+    try:
+        with open(OFFERS_CACHE_FILE, encoding='utf-8') as file_:
+            caches.append(json.load(file_))
+    except (OSError, ValueError):
+        pass
+    if OFFERS_CACHE_S3 and not (caches and is_fresh(caches[0])):
+        try:
+            cache = json.loads(s3.get_object(Bucket=BUCKET_NAME, Key=OFFERS_CACHE_KEY)['Body'].read())
+            cache['from_s3'] = True
+            caches.append(cache)
+        except ClientError as exc:
+            logger.debug(f'No offers cache in s3: {exc}')
+    return max(caches, key=lambda cache: cache['fetched_at'], default=None)
+
+def write_offers_cache(s3, cache, to_s3=True):
+    cache.pop('from_s3', None)
+    with open(OFFERS_CACHE_FILE, 'w', encoding='utf-8') as file_:
+        json.dump(cache, file_)
+    if OFFERS_CACHE_S3 and to_s3:
+        try:
+            s3.put_object(Bucket=BUCKET_NAME, Key=OFFERS_CACHE_KEY, Body=json.dumps(cache))
+        except ClientError as exc:
+            logger.warning(f'Cannot store offers cache in s3: {exc}')
+
+def get_offers(s3):
+    """ returns the offers of the index. The index is cached for OFFERS_CACHE_TTL seconds
+    and then revalidated with its ETag, so an unchanged index is not downloaded again
+    """
+    cache = read_offers_cache(s3)
+    if cache and is_fresh(cache):
+        logger.info('Using cached offers index')
+        if cache.get('from_s3'):
+            write_offers_cache(s3, cache, to_s3=False) # for the next warm invocations
+        return cache['offers']
+    headers = {'If-None-Match': cache['etag']} if cache and cache.get('etag') else {}
+    res = HTTP.request('GET', OFFERS_URL, headers=headers)
+    if res.status == 304:
+        logger.info('Offers index not modified')
+        cache['fetched_at'] = time.time()
+    elif res.status == 200:
+        cache = {
+            'etag': res.headers.get('ETag'),
+            'fetched_at': time.time(),
+            'offers': json.loads(res.data)['offers'],
+        }
+    elif cache:
+        logger.warning(f'Cannot get offers index (HTTP {res.status}), using cached version')
+        return cache['offers']
+    else:
+        raise RuntimeError(f'Cannot get offers index: HTTP {res.status}')
+    write_offers_cache(s3, cache)
+    return cache['offers']
+
+def get_versions(s3, path):
+    """ returns {region_code: versionUrl} of the last successful upload of each region """
+    try:
+        return json.loads(s3.get_object(Bucket=BUCKET_NAME, Key=versions_key(path))['Body'].read())
+    except ClientError as exc:
+        if exc.response['Error']['Code'] != 'NoSuchKey':
+            logger.warning(f'Cannot read pricing versions of {path}: {exc}')
+        return {}
+
+def put_versions(s3, path, versions):
+    s3.put_object(Bucket=BUCKET_NAME, Key=versions_key(path), Body=json.dumps(versions, indent=2))
+
+def versions_key(path):
+    """ stored outside of the crawled pricing data """
+    return f"pricing/pricing-versions/{path}.json"
+
+def get_version(path, region):
+    """ returns the version of the region data, including the format and transform so a new transform is applied to all regions """
+    version_url = region.get("versionUrl") or region.get("currentVersionUrl")
+    if version_url and path in TRANSFORMS:
+        version_url += f"#{output_format(path)}-" + hashlib.sha1(json.dumps(TRANSFORMS[path], sort_keys=True).encode()).hexdigest()[:8]
+    return version_url
+
+def output_format(path):
+    return TRANSFORMS[path].get('format', 'csv') if path in TRANSFORMS else 'csv'
+
+def version_format(version):
+    """ returns the output format of a version returned by get_version. Regions without version were uploaded as csv """
+    if not version or '#' not in version:
+        return 'csv'
+    return version.split('#', 1)[1].rsplit('-', 1)[0]
+
+class PrefetchReader(io.RawIOBase):
+    """ reads a stream in a background thread, up to `chunks` chunks ahead of the consumer,
+    so the download overlaps with the processing of the data
+    """
+    def __init__(self, stream, chunk_size=1024 * 1024, chunks=PREFETCH_CHUNKS):
+        super().__init__()
+        self._queue = queue.Queue(maxsize=chunks)
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._prefetch, args=(stream, chunk_size), daemon=True)
+        self._thread.start()
+
+    def _prefetch(self, stream, chunk_size):
+        try:
+            while not self._stop.is_set():
+                chunk = stream.read(chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except Exception as exc: #pylint: disable=broad-exception-caught
+            self._put(exc)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and not self._eof:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            self._eof = not item
+            self._chunk = memoryview(item)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        self._stop.set() # unblocks the prefetch thread if the consumer stops early
+        super().close()
 
-def upload_pricing(service, path):
+def get_selection(header, transform):
+    """ returns the indexes of the kept columns and the filters as {column index: allowed values}.
+    Columns are kept in the order of transform['columns'], the order of the table (csv columns
+    are mapped by position), with None for the columns missing from the data.
+    Column names are not case sensitive.
+    """
+    names = [name.lower() for name in header]
+    columns = [name.lower() for name in transform.get('columns', [])]
+    missing = set(columns) - set(names)
+    if missing:
+        logger.warning(f'Columns not found in pricing data, written empty: {sorted(missing)}')
+    kept = [names.index(name) if name in names else None for name in columns] if columns else list(range(len(names)))
+    filters = {}
+    for name, values in transform.get('filters', {}).items():
+        if name.lower() not in names:
+            raise ValueError(f'Filter column {name} not found in pricing data')
+        filters[names.index(name.lower())] = set(values)
+    return kept, filters
+
+def transform_region(s3, file_obj, key, transform):
+    """ streams the csv through the column selection and row filters of the transform to s3.
+    Download (PrefetchReader), transform (this thread) and upload (S3MultipartSink) run concurrently.
+    Returns the number of rows written.
+    """
+    fmt = transform.get('format', 'csv')
+    types = {name.lower(): type_ for name, type_ in transform.get('types', {}).items()}
+    with PrefetchReader(file_obj) as raw:
+        rows = csv.reader(io.TextIOWrapper(io.BufferedReader(raw, buffer_size=1024 * 1024), encoding='utf-8', newline=''))
+        for _ in range(5): # Skip 5 lines
+            next(rows)
+        header = next(rows)
+        kept, filters = get_selection(header, transform)
+        fieldnames = [name if index is None else header[index] for name, index in zip(transform.get('columns') or header, kept)]
+        options = {'fieldnames': fieldnames}
+        if fmt == 'parquet':
+            options = {'schema': [(name.lower(), types.get(name.lower(), 'string')) for name in fieldnames]}
+        with open_s3_writer(BUCKET_NAME, key, fmt, s3_client=s3, **options) as writer:
+            for row in rows:
+                if row and all(row[index] in values for index, values in filters.items()):
+                    writer.write(['' if index is None else row[index] for index in kept])
+    return writer.count
+
+def delete_other_formats(s3, prefix, current):
+    """ removes the outputs of a previous format, so a table does not read both """
+    for fmt in OUTPUT_FORMATS:
+        if extension(fmt) != current:
+            try:
+                s3.delete_object(Bucket=BUCKET_NAME, Key=f"{prefix}index{extension(fmt)}")
+            except ClientError as exc:
+                logger.warning(f'Cannot delete {prefix}index{extension(fmt)}: {exc}')
+
+def upload_region(s3, http, path, region, previous_format='csv'):
+    """ download the region csv and upload it to s3, transformed if a transform is configured for the path.
+    The files of previous_format are removed if it is not the current format.
+    """
+    region_code = region["regionCode"]
+    version_url =  region.get("versionUrl") or region.get("currentVersionUrl")
+    assert version_url
+    region_url = BASE_URL + version_url.replace(".json", ".csv")
+    prefix = f"pricing/pricing-{path}-data/region={region_code}/"
+
+    # Starting Download
+    file_obj = http.request('GET', region_url, preload_content=False)
+    try:
+        if path in TRANSFORMS:
+            fmt = output_format(path)
+            if fmt not in OUTPUT_FORMATS:
+                raise ValueError(f"Unsupported pricing format '{fmt}'. Supported: {OUTPUT_FORMATS}")
+            key = f"{prefix}index{extension(fmt)}"
+            count = transform_region(s3, file_obj, key, TRANSFORMS[path])
+            logger.debug(f'{count} rows uploaded to s3://{BUCKET_NAME}/{key}')
+        else:
+            # Skip 5 lines
+            for _ in range(5):
+                file_obj.readline()
+
+            # Upload
+            key = f"{prefix}index.csv"
+            res = s3.upload_fileobj(Fileobj=file_obj, Bucket=BUCKET_NAME, Key=key)
+            logger.debug(f'{res} Uploaded to s3://{BUCKET_NAME}/{key}')
+    finally:
+        file_obj.release_conn()
+    if previous_format != output_format(path):
+        delete_other_formats(s3, prefix, key[len(prefix) + len('index'):])
+
+def upload_pricing(service, path, force=False):
     s3 = boto3.client('s3')
-    http = urllib3.PoolManager()
-    offers = get_json(OFFERS_URL)['offers']
+    offers = get_offers(s3)
 
     errors = ''
 
@@ -45,34 +295,39 @@ def upload_pricing(service, path):
     if isinstance(regions, dict): # pricing data has different formats
         regions = regions.values()
 
-    # pull pricing for each region
+    # pull pricing for each region, skipping the ones with the same version as the last upload
+    uploaded = get_versions(s3, path)
+    versions = {} if force else dict(uploaded)
+    todo = []
     for region in regions:
         region_code = region["regionCode"]
         if REGIONS and (region_code not in REGIONS):
             logger.debug(f'Filtering out {region_code}')
             continue
-        try:
-            version_url =  region.get("versionUrl") or region.get("currentVersionUrl")
-            assert version_url
-            region_url = BASE_URL + version_url.replace(".json", ".csv")
-
-            # Starting Download
-            file_obj = http.request('GET', region_url, preload_content=False)
-
-            # Skip 5 lines
-            for _ in range(5):
-                file_obj.readline()
+        version = get_version(path, region)
+        if version and versions.get(region_code) == version:
+            logger.info(f'Skipping {region_code}: version {version} already uploaded')
+            continue
+        todo.append(region)
 
-            # Upload
-            key = f"pricing/pricing-{path}-data/region={region_code}/index.csv"
-            res = s3.upload_fileobj(Fileobj=file_obj, Bucket=BUCKET_NAME, Key=key)
-            logger.debug(f'{res} Uploaded to s3://{BUCKET_NAME}/{key}')
-        except Exception as exc:
-            err = f'{service}/{region_code}: {exc}'
-            logger.warning(err)
-            logger.exception(exc)
-            errors += err + '\n'
-            raise
+    first_exc = None
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {region["regionCode"]: (region, executor.submit(upload_region, s3, HTTP, path, region, version_format(uploaded.get(region["regionCode"])))) for region in todo}
+        for region_code, (region, future) in futures.items():
+            try:
+                future.result()
+                versions[region_code] = get_version(path, region)
+            except Exception as exc:
+                err = f'{service}/{region_code}: {exc}'
+                logger.warning(err)
+                logger.exception(exc)
+                errors += err + '\n'
+                first_exc = first_exc or exc
+    if todo:
+        put_versions(s3, path, versions) # record the successful regions even if others failed
+    if first_exc:
+        raise first_exc
+    logger.info(f'Uploaded {len(todo)} regions, {len(regions) - len(todo)} skipped or filtered out')
     return {
         'statusCode': 200,
         'errors': errors,
@@ -123,7 +378,7 @@ def lambda_handler(event, context):
             'body': {service: res}
         }
     else:
-        res = upload_pricing(service, path)
+        res = upload_pricing(service, path, force=event.get('force', False))
 
     # FIXME: move it to separate lambda?
     try:
@@ -1,18 +1,34 @@
 import os
 import json
+import time
 from datetime import date, datetime
 from json import JSONEncoder
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.client import Config
+from botocore.exceptions import BotoCoreError, ClientError
 import logging
 
+from cid_dc.sts import broker
+from cid_dc.writers import open_s3_writer, extension
+from cid_dc.throttle import AdaptiveTokenBucket, call_with_backoff
+
 PREFIX = os.environ["PREFIX"]
 BUCKET = os.environ["BUCKET_NAME"]
 ROLE_NAME = os.environ['ROLENAME']
 COSTONLY = os.environ.get('COSTONLY', 'no').lower() == 'yes'
-TMP_FILE = "/tmp/data.json"
 REGIONS = ["us-east-1"]
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'json')
+SKIP_UNFLAGGED = os.environ.get('SKIP_UNFLAGGED', 'yes').lower() == 'yes'
+SUMMARY_BATCH = int(os.environ.get('SUMMARY_BATCH', '100'))
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+TA_API_RATE = float(os.environ.get('TA_API_RATE', '10'))
+# the check catalog is the same in all accounts: it is cached in /tmp and optionally in s3 for CATALOG_TTL seconds
+CATALOG_TTL = int(os.environ.get('CATALOG_TTL', '86400'))
+CATALOG_S3 = os.environ.get('CATALOG_S3', 'yes').lower() == 'yes'
+CATALOG_FILE = '/tmp/trusted-advisor-checks.json'
+CATALOG_KEY = f'{PREFIX}/check-catalog/checks-en.json'
 
 #config to avoid ThrottlingException
 config = Config(
@@ -25,6 +41,8 @@ config = Config(
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
 
+limiter = AdaptiveTokenBucket(TA_API_RATE)
+
 def lambda_handler(event, context):
     collection_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     if 'account' not in event:
@@ -38,64 +56,187 @@ def lambda_handler(event, context):
         account_name = account["account_name"]
         payer_id = account["payer_id"]
         logger.info(f"Collecting data for account: {account_id}")
-        read_ta(account_id, account_name)
-        upload_to_s3(account_id, payer_id)
+        read_ta(account_id, account_name, payer_id)
     except Exception as e:
         logging.warning(e)
+    broker.log_stats()
 
-def upload_to_s3(account_id, payer_id):
-    if os.path.getsize(TMP_FILE) == 0:
-        print(f"No data in file for {PREFIX}")
-        return
+def get_s3_key(account_id, payer_id):
     d = datetime.now()
     month = d.strftime("%m")
     year = d.strftime("%Y")
     _date = d.strftime("%d%m%Y-%H%M%S")
-    key = f"{PREFIX}/{PREFIX}-data/payer_id={payer_id}/year={year}/month={month}/{PREFIX}-{account_id}-{_date}.json"
-    try:
-        boto3.client("s3").upload_file(TMP_FILE, BUCKET, key)
-        print(f"Data for {account_id} in s3 - {key}")
-    except Exception as e:
-        print(f"{type(e)}: {e}")
+    return f"{PREFIX}/{PREFIX}-data/payer_id={payer_id}/year={year}/month={month}/{PREFIX}-{account_id}-{_date}{extension(OUTPUT_FORMAT)}"
 
 def assume_role(account_id, service, region, role):
-    assumed = boto3.client('sts', region_name=region).assume_role(
-        RoleArn=f"arn:aws:iam::{account_id}:role/{role}",
-        RoleSessionName='data_collection'
-    )
-    creds = assumed['Credentials']
-    return boto3.client(service, region_name=region,
-        aws_access_key_id=creds['AccessKeyId'],
-        aws_secret_access_key=creds['SecretAccessKey'],
-        aws_session_token=creds['SessionToken'],
-        config=config,
-    )
+    return broker.client(account_id, role, service, region, config=config)
 
 def _json_serial(self, obj):
     if isinstance(obj, (datetime, date)): return obj.isoformat()
     return JSONEncoder.default(self, obj)
 
-def read_ta(account_id, account_name):
-    f = open(TMP_FILE, "w")
-    support = assume_role(account_id, "support", REGIONS[0], ROLE_NAME)
-    checks = support.describe_trusted_advisor_checks(language="en")["checks"]
-    for check in checks:
-        if (COSTONLY and check.get("category") != "cost_optimizing"): continue
+def read_ta(account_id, account_name, payer_id):
+    """ stream flagged resources of all checks to s3 and return the number of records """
+    key = get_s3_key(account_id, payer_id)
+    with open_s3_writer(BUCKET, key, OUTPUT_FORMAT, serializer=lambda rec: json.dumps(rec, default=_json_serial)) as writer:
+        support = assume_role(account_id, "support", REGIONS[0], ROLE_NAME)
+        checks = get_checks(support)
+        checks = [check for check in checks if not (COSTONLY and check.get("category") != "cost_optimizing")]
+        if SKIP_UNFLAGGED:
+            checks = flagged_checks(support, checks)
+        compiled_checks = {check["id"]: compile_check(check) for check in checks}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # results are written in the order of the checks, as they complete
+            for check, result in executor.map(lambda check: (check, get_check_result(support, check)), checks):
+                if isinstance(result, Exception):
+                    logger.warning(f'Cannot read check {check["id"]}: {type(result)}: {result}')
+                    continue
+                try:
+                    for output in flagged_resources(check, result, account_id, account_name, compiled_checks):
+                        writer.write(output)
+                except Exception as e:
+                    logger.warning(f'Cannot process check {check["id"]}: {type(e)}: {e}')
+    if writer.count == 0:
+        logger.warning(f"No data in file for {PREFIX}")
+    else:
+        logger.info(f"Data for {account_id} in s3 - {key}")
+    return writer.count
+
+def flagged_checks(support, checks):
+    """ returns the checks with flagged resources according to their summaries, or all checks if summaries are not available """
+    flagged = []
+    for i in range(0, len(checks), SUMMARY_BATCH):
+        batch = checks[i:i + SUMMARY_BATCH]
         try:
-            result = support.describe_trusted_advisor_check_result(checkId=check["id"], language="en")['result']
-            if result.get("status") == "not_available": continue
-            dt = result['timestamp']
-            ts = datetime.strptime(dt, '%Y-%m-%dT%H:%M:%SZ').strftime('%s')
-            for resource in result["flaggedResources"]:
-                output = {}
-                if "metadata" in resource:
-                    output.update(dict(zip(check["metadata"], resource["metadata"])))
-                    del resource['metadata']
-                resource["Region"] = resource.pop("region") if "region" in resource else '-'
-                resource["Status"] = resource.pop("status") if "status" in resource else '-'
-                output.update({"AccountId":account_id, "AccountName":account_name, "Category": check["category"], 'DateTime': dt, 'Timestamp': ts, "CheckName": check["name"], "CheckId": check["id"]})
-                output.update(resource)
-                output = {k.lower(): v for k, v in output.items()}
-                f.write(json.dumps(output, default=_json_serial) + "\n")
-        except Exception as e:
-            print(f'{type(e)}: {e}')
\ No newline at end of file
+            summaries = call_with_backoff(limiter, support.describe_trusted_advisor_check_summaries, checkIds=[check["id"] for check in batch])['summaries']
+        except Exception as e: #pylint: disable=broad-exception-caught
+            logger.warning(f'Cannot read check summaries, reading all results: {type(e)}: {e}')
+            return checks
+        summaries = {summary['checkId']: summary for summary in summaries}
+        for check in batch:
+            summary = summaries.get(check["id"])
+            if summary is None or has_flagged_resources(summary):
+                flagged.append(check)
+    logger.info(f'{len(flagged)} of {len(checks)} checks have flagged resources')
+    return flagged
+
+def has_flagged_resources(summary):
+    if summary.get("status") == "not_available":
+        return False
+    return summary.get("hasFlaggedResources", True) or summary.get("resourcesSummary", {}).get("resourcesFlagged", 1) > 0
+
+def get_check_result(support, check):
+    """ returns the result of a check, or the exception raised """
+    try:
+        return call_with_backoff(limiter, support.describe_trusted_advisor_check_result, checkId=check["id"], language="en")['result']
+    except Exception as e: #pylint: disable=broad-exception-caught
+        return e
+
+def get_checks(support):
+    """ returns the check catalog from /tmp, s3 or the api, in this order, and refreshes the caches """
+    catalog = read_catalog_file()
+    if catalog is None and CATALOG_S3:
+        catalog = read_catalog_s3()
+        if catalog is not None:
+            write_catalog_file(catalog)
+    if catalog is None:
+        catalog = {'created_at': time.time(), 'checks': support.describe_trusted_advisor_checks(language="en")["checks"]}
+        write_catalog_file(catalog)
+        if CATALOG_S3:
+            write_catalog_s3(catalog)
+    return catalog['checks']
+
+def is_fresh(catalog):
+    return catalog is not None and time.time() - catalog.get('created_at', 0) < CATALOG_TTL
+
+def read_catalog_file():
+    try:
+        with open(CATALOG_FILE, encoding='utf-8') as file_:
+            catalog = json.load(file_)
+    except (OSError, ValueError):
+        return None
+    return catalog if is_fresh(catalog) else None
+
+def write_catalog_file(catalog):
+    tmp_file = f'{CATALOG_FILE}.{os.getpid()}'
+    with open(tmp_file, 'w', encoding='utf-8') as file_:
+        json.dump(catalog, file_)
+    os.replace(tmp_file, CATALOG_FILE) # concurrent readers never see a partial file
+
+def read_catalog_s3():
+    try:
+        catalog = json.loads(boto3.client('s3').get_object(Bucket=BUCKET, Key=CATALOG_KEY)['Body'].read())
+    except (BotoCoreError, ClientError) as exc:
+        logger.debug(f'No check catalog in s3: {exc}')
+        return None
+    return catalog if is_fresh(catalog) else None
+
+def write_catalog_s3(catalog):
+    try:
+        boto3.client('s3').put_object(Bucket=BUCKET, Key=CATALOG_KEY, Body=json.dumps(catalog))
+    except (BotoCoreError, ClientError) as exc:
+        logger.warning(f'Cannot store the check catalog in s3: {exc}')
+
+RESULT_FIELDS = ["AccountId", "AccountName", "Category", "DateTime", "Timestamp", "CheckName", "CheckId"]
+LOWER_RESULT_FIELDS = [name.lower() for name in RESULT_FIELDS]
+
+def compile_check(check):
+    """ returns a function flattening a flagged resource of the check and the fields of its result into a record
+
+    Records have lowercase keys. The lowercase names of the metadata columns and of the resource
+    keys are computed once per check and per resource layout (its keys and number of metadata values).
+    """
+    columns = check["metadata"]
+    lower_columns = [name.lower() for name in columns]
+    layouts = {}
+
+    def compile_layout(resource):
+        """ returns the (key, lowercase key) of the resource, or None if two keys of the record differ only by case """
+        metadata = columns[:len(resource["metadata"])] if "metadata" in resource else []
+        keys = [key for key in resource if key not in ("metadata", "region", "status")]
+        names = list(dict.fromkeys(metadata + RESULT_FIELDS + keys + ["Region", "Status"]))
+        if len({name.lower() for name in names}) < len(names):
+            return None
+        return [(key, key.lower()) for key in keys]
+
+    def flatten(resource, fields):
+        signature = (tuple(resource), len(resource.get("metadata") or ()))
+        if signature not in layouts:
+            layouts[signature] = compile_layout(resource)
+        layout = layouts[signature]
+        if layout is None:
+            return flatten_exact(resource, fields)
+        output = dict(zip(lower_columns, resource["metadata"])) if "metadata" in resource else {}
+        output.update(zip(LOWER_RESULT_FIELDS, fields.values()))
+        for key, lower in layout:
+            output[lower] = resource[key]
+        output["region"] = resource.get("region", '-')
+        output["status"] = resource.get("status", '-')
+        return output
+
+    def flatten_exact(resource, fields):
+        # keys keep their case until the end, so keys differing only by case resolve as they always did
+        output = dict(zip(columns, resource["metadata"])) if "metadata" in resource else {}
+        output.update(fields)
+        for key, value in resource.items():
+            if key not in ("metadata", "region", "status"):
+                output[key] = value
+        output["Region"] = resource.get("region", '-')
+        output["Status"] = resource.get("status", '-')
+        return {key.lower(): value for key, value in output.items()}
+
+    return flatten
+
+def flagged_resources(check, result, account_id, account_name, compiled_checks=None):
+    """ yields the records of the flagged resources of a check result """
+    if result.get("status") == "not_available": return
+    dt = result['timestamp']
+    ts = datetime.strptime(dt, '%Y-%m-%dT%H:%M:%SZ').strftime('%s')
+    if compiled_checks is None:
+        compiled_checks = {}
+    if check["id"] not in compiled_checks:
+        compiled_checks[check["id"]] = compile_check(check)
+    flatten = compiled_checks[check["id"]]
+    fields = dict(zip(RESULT_FIELDS, [account_id, account_name, check["category"], dt, ts, check["name"], check["id"]]))
+    for resource in result["flaggedResources"]:
+        yield flatten(resource, fields)
@@ -108,5 +108,24 @@ resource "aws_iam_role" "step_function_execution_role" {
       ]
     })
   }
+
+  # results of the account shards (account durations), read by the account collector
+  inline_policy {
+    name = "S3-ShardResults"
+    policy = jsonencode({
+      Version = "2012-10-17"
+      Statement = [
+        {
+          Effect = "Allow"
+          Action = [
+            "s3:PutObject",
+            "s3:ListMultipartUploadParts",
+            "s3:AbortMultipartUpload"
+          ]
+          Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/account-list/results/*"
+        }
+      ]
+    })
+  }
 }
 
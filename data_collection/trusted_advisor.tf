@@ -40,9 +40,15 @@ resource "aws_iam_role" "lambda_role_trusted_advisor" {
         {
           Effect = "Allow"
           Action = [
-            "s3:PutObject"
+            "s3:PutObject",
+            "s3:AbortMultipartUpload"
           ]
           Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/*"
+        },
+        {
+          Effect   = "Allow"
+          Action   = "s3:GetObject"
+          Resource = "arn:aws:s3:::cid-data-${data.aws_caller_identity.current.account_id}/trusted-advisor/check-catalog/*"
         }
       ]
     })
@@ -65,13 +71,15 @@ resource "aws_lambda_function" "lambda_function_trusted_advisor" {
   role          = aws_iam_role.lambda_role_trusted_advisor.arn
   memory_size   = 2688
   timeout       = 300
+  layers        = local.module_layers["trusted-advisor"]
 
   environment {
     variables = {
-      BUCKET_NAME = "cid-data-${data.aws_caller_identity.current.account_id}"
-      PREFIX      = "trusted-advisor"
-      ROLENAME    = "CID-DC-Optimization-Data-Multi-Account-Role"
-      COSTONLY    = "no"
+      BUCKET_NAME   = "cid-data-${data.aws_caller_identity.current.account_id}"
+      PREFIX        = "trusted-advisor"
+      ROLENAME      = "CID-DC-Optimization-Data-Multi-Account-Role"
+      COSTONLY      = "no"
+      OUTPUT_FORMAT = local.output_format["trusted-advisor"]
     }
   }
 }
@@ -88,7 +96,8 @@ resource "aws_glue_crawler" "crawler_trusted_advisor" {
   database_name = "optimization_data"
 
   s3_target {
-    path = "s3://cid-data-${data.aws_caller_identity.current.account_id}/trusted-advisor/trusted-advisor-data/"
+    path       = "s3://cid-data-${data.aws_caller_identity.current.account_id}/trusted-advisor/trusted-advisor-data/"
+    exclusions = local.output_format_exclusions[local.output_format["trusted-advisor"]]
   }
 
   configuration = jsonencode({
@@ -103,12 +112,16 @@ resource "aws_glue_crawler" "crawler_trusted_advisor" {
 resource "aws_sfn_state_machine" "sfn_trusted_advisor" {
   name     = "CID-DC-trusted-advisor-StateMachine"
   role_arn = aws_iam_role.step_function_execution_role.arn
-  definition = templatefile("./definitions/template.asl.json", {
+  definition = templatefile(local.sfn_template["trusted-advisor"], {
     "account_id"  = data.aws_caller_identity.current.account_id
     "module_name" = "trusted-advisor"
     "type"        = "LINKED"
     "crawler"     = "CID-DC-trusted-advisor-Crawler"
     "params"      = ""
+    "shard_name"  = "trusted-advisor"
+    "batch_size"  = local.account_shards["trusted-advisor"].batch_size
+    "max_weight"  = local.account_shards["trusted-advisor"].max_weight
+    "timeout"     = local.account_shards["trusted-advisor"].timeout_seconds
   })
 }
 
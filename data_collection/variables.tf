@@ -323,3 +323,148 @@ variable "enabled_regions" {
   description = "List of regions to collect data from."
   default     = "us-east-1"
 }
+
+variable "inventory_combined_collection" {
+  type        = bool
+  description = "Collect all inventory sub modules in a single state machine run per account instead of one run per sub module."
+  default     = false
+}
+
+variable "inventory_delta_mode" {
+  type        = bool
+  description = "Write only added, changed and removed inventory resources between full baselines."
+  default     = false
+}
+
+variable "inventory_baseline_period_runs" {
+  type        = number
+  description = "Number of scheduled inventory runs (every 14 days) between two full inventory baselines in delta mode. The runs in between write only the changes."
+  default     = 4
+
+  validation {
+    condition     = var.inventory_baseline_period_runs >= 1 && floor(var.inventory_baseline_period_runs) == var.inventory_baseline_period_runs
+    error_message = "inventory_baseline_period_runs must be a whole number of runs, 1 or more. 1 writes a baseline on every run."
+  }
+}
+
+variable "output_formats" {
+  type        = map(string)
+  description = "Output format per module (inventory, budgets, trusted-advisor, cost-anomaly, organizations): json (default), json.gz or parquet. Parquet requires parquet_layer_arn, its columns are strings (nested values as JSON)."
+  default     = {}
+  # csv needs fixed columns: it is only available for the pricing transforms
+  validation {
+    condition     = alltrue([for module, format in var.output_formats : contains(["inventory", "budgets", "trusted-advisor", "cost-anomaly", "organizations"], module) && contains(["json", "json.gz", "parquet"], format)])
+    error_message = "output_formats keys must be inventory, budgets, trusted-advisor, cost-anomaly or organizations, and values json, json.gz or parquet."
+  }
+}
+
+variable "parquet_layer_arn" {
+  type        = string
+  description = "ARN of a Lambda layer providing pyarrow (ex: AWS SDK for pandas) for the modules writing parquet. It must match the runtime of the module Lambda."
+  default     = ""
+}
+
+variable "org_snapshot_ttl" {
+  type        = number
+  description = "Seconds during which the account collector uses the organization account list stored in s3 by the organizations module or a previous collection, instead of listing the organization again. 0 always lists the organization."
+  default     = 21600
+}
+
+variable "account_shards" {
+  type = map(object({
+    batch_size = optional(number, 25)
+    max_weight = optional(number, 300)
+  }))
+  description = "Optional cost-weighted account shards per LINKED module state machine (budgets, trusted-advisor, inventory or inventory-<sub module>). The accounts of a shard are collected one after the other, up to batch_size accounts and max_weight seconds, weighted by their duration in the previous run. Heavier accounts, and accounts without a previous duration, get their own shard."
+  default     = {}
+}
+
+locals {
+  # a shard lasts about max_weight seconds, plus one module Lambda timeout (300s) for an account over its
+  # estimate: the state machine allows 4 waves of shards, and never less than the unsharded 1200s
+  account_shards = {
+    for name in concat(["budgets", "trusted-advisor", "inventory"], [for key in keys(local.inventory_map) : "inventory-${key}"]) :
+    name => merge(lookup(var.account_shards, name, { batch_size = 25, max_weight = 300 }), {
+      timeout_seconds = max(1200, 4 * (lookup(var.account_shards, name, { batch_size = 25, max_weight = 300 }).max_weight + 300))
+    })
+  }
+  sfn_template = {
+    for name in keys(local.account_shards) :
+    name => contains(keys(var.account_shards), name) ? "./definitions/template_sharded.asl.json" : "./definitions/template.asl.json"
+  }
+}
+
+variable "pricing_transforms" {
+  type = map(object({
+    columns = optional(list(string), [])
+    filters = optional(map(list(string)), {})
+    format  = optional(string, "csv")
+  }))
+  description = "Optional streaming transform of the pricing data per service path (ec2, rds, ...): columns of the pricing table to keep (all by default, written in table order), row filters as {column = [allowed values]} and output format (csv, csv.gz or parquet). Parquet requires parquet_layer_arn."
+  default     = {}
+}
+
+locals {
+  # the columns (in table order) and types let the Lambda write columns matching the pricing tables
+  pricing_transforms = {
+    for service, value in local.ServicesMapPricing : value.path => merge(var.pricing_transforms[value.path], {
+      columns = [for field in local.pricing_fields[value.path] : field.Name]
+      types   = { for field in value.fields : field.Name => field.Type if field.Type != "string" }
+    }) if contains(keys(var.pricing_transforms), value.path)
+  }
+}
+
+locals {
+  output_format = {
+    for module in ["inventory", "budgets", "trusted-advisor", "cost-anomaly", "organizations"] :
+    module => lookup(var.output_formats, module, "json")
+  }
+  # crawlers ignore files of the other formats, so switching format does not mix schemas in a table
+  output_format_exclusions = {
+    "json"    = ["**.parquet", "**.csv", "**.csv.gz"]
+    "json.gz" = ["**.parquet", "**.csv", "**.csv.gz"]
+    "parquet" = ["**.json", "**.json.gz", "**.csv", "**.csv.gz"]
+    "csv"     = ["**.json", "**.json.gz", "**.parquet"]
+    "csv.gz"  = ["**.json", "**.json.gz", "**.parquet"]
+  }
+}
+
+variable "cost_anomaly_split_mode" {
+  type        = string
+  description = "How the cost anomaly module fetches the anomalies of a payer: none (one paginated request), window (concurrent sub-windows of cost_anomaly_window_days) or monitor (concurrently per anomaly monitor, requires ce:GetAnomalyMonitors in the management account role)."
+  default     = "none"
+  validation {
+    condition     = contains(["none", "window", "monitor"], var.cost_anomaly_split_mode)
+    error_message = "cost_anomaly_split_mode must be none, window or monitor."
+  }
+}
+
+variable "cost_anomaly_window_days" {
+  type        = number
+  description = "Days per sub-window when cost_anomaly_split_mode is window."
+  default     = 15
+}
+
+variable "cost_anomaly_upsert_index" {
+  type        = bool
+  description = "Keep an index of the cost anomalies already collected (s3 indexes/cost-anomaly/) so each run writes only the new or changed anomalies, and a compacted dataset with the latest state of each anomaly (cost-anomaly/cost-anomaly-latest/). Daily files then hold only the changes of a run."
+  default     = false
+}
+
+variable "cost_anomaly_compact_days" {
+  type        = number
+  description = "Days between two rewrites of the latest state dataset of cost anomalies when cost_anomaly_upsert_index is enabled. Anomalies that ended more than 90 days ago are dropped from the index and the dataset at each rewrite."
+  default     = 7
+}
+
+variable "compute_optimizer_skip_existing" {
+  type        = bool
+  description = "Do not export again the compute optimizer recommendations already exported successfully this month (export jobs of the last 7 days) to the same prefix. The data of the month then comes from its first export."
+  default     = false
+}
+
+variable "compute_optimizer_track_exports" {
+  type        = bool
+  description = "Wait for the compute optimizer export jobs (until 30s before the Lambda timeout) and log the duration and size of each, failed exports are reported as errors."
+  default     = false
+}
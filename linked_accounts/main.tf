@@ -43,7 +43,8 @@ resource "aws_iam_policy" "ta_policy" {
       Effect = "Allow",
       Action = [
         "support:DescribeTrustedAdvisorChecks",
-        "support:DescribeTrustedAdvisorCheckResult"
+        "support:DescribeTrustedAdvisorCheckResult",
+        "support:DescribeTrustedAdvisorCheckSummaries"
       ],
       Resource = "*"
     }]
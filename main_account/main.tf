@@ -87,7 +87,7 @@ resource "aws_iam_policy" "cost_anomalies_policy" {
     Statement = [
       {
         Effect   = "Allow"
-        Action   = ["ce:GetAnomalies"]
+        Action   = ["ce:GetAnomalies", "ce:GetAnomalyMonitors"]
         Resource = "*"
       }
     ]
@@ -189,6 +189,11 @@ resource "aws_iam_policy" "compute_optimizer_policy" {
           "rds:DescribeDBClusters"
         ]
         Resource = "*"
+      },
+      {
+        Effect   = "Allow"
+        Action   = ["compute-optimizer:DescribeRecommendationExportJobs"]
+        Resource = "*"
       }
     ]
   })